@@ -0,0 +1,307 @@
+"""Storage backends."""
+import hashlib
+import mmap
+import os
+import time
+from abc import ABC, abstractmethod
+from io import BytesIO
+from shutil import copyfileobj, rmtree
+from tempfile import NamedTemporaryFile
+from urllib.parse import quote, urlencode
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+# Keys in one page of listing
+LIST_PAGE_SIZE = 1000
+
+
+class UploadError(Exception):
+    """Multipart upload is unknown, or its parts can't be combined"""
+
+
+class StorageBackend(ABC):
+    """
+    Object storage, objects are stored by keys like `images/{id}/image-{id}.png`.
+    Pre-signed urls and posts give clients direct access without the app.
+    """
+
+    @abstractmethod
+    def sign_urls(self, keys, expiry):
+        """Pre-signed GET urls by key, valid for expiry seconds"""
+
+    @abstractmethod
+    def presigned_post(self, key, expiry, content_type=None, max_size=None):
+        """
+        Pre-signed POST form (url and fields) to upload the key. Uploads are rejected
+        unless they have the content type and at most max_size bytes, if given
+        """
+
+    @abstractmethod
+    def put(self, key, fileobj):
+        """Store file object under the key"""
+
+    @abstractmethod
+    def open(self, key):
+        """Readable and seekable file object of the key, close it when done"""
+
+    @abstractmethod
+    def read_header(self, key, length):
+        """First length bytes of the key and its full size in bytes"""
+
+    @abstractmethod
+    def exists(self, key):
+        """True if the key exists"""
+
+    @abstractmethod
+    def size(self, key):
+        """Object size in bytes, None if key doesn't exist"""
+
+    @abstractmethod
+    def delete(self, keys):
+        """Delete a batch of keys, returns keys failed to delete"""
+
+    @abstractmethod
+    def list(self, prefix):
+        """Keys under the prefix, yields pages of up to 1000 keys"""
+
+    @abstractmethod
+    def create_multipart(self, key, content_type):
+        """Start a multipart upload of the key, returns its upload id"""
+
+    @abstractmethod
+    def sign_part_urls(self, key, upload_id, part_numbers, expiry):
+        """Pre-signed PUT urls by part number, valid for expiry seconds"""
+
+    @abstractmethod
+    def list_parts(self, key, upload_id):
+        """Uploaded parts as dicts of part_number, etag and size, by part number"""
+
+    @abstractmethod
+    def complete_multipart(self, key, upload_id, parts):
+        """Combine (part_number, etag) parts into the key, in part number order"""
+
+    @abstractmethod
+    def abort_multipart(self, key, upload_id):
+        """Drop the upload and its uploaded parts"""
+
+
+class FileSystemBackend(StorageBackend):
+    """
+    Objects stored as files under STORAGE_ROOT, for single node deployments and
+    hermetic tests. Reads are served from memory mapped files, pre-signed urls are
+    local urls under STORAGE_URL signed with the SECRET_KEY.
+    """
+
+    salt = "apps.contrib.backends.FileSystemBackend"
+
+    def __init__(self, root=None, base_url=None):
+        self.root = os.path.abspath(root or settings.STORAGE_ROOT)
+        self.base_url = base_url or settings.STORAGE_URL
+
+    def path(self, key):
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise SuspiciousFileOperation(f"Key {key} is outside of storage root")
+        return path
+
+    def sign(self, method, key, expires):
+        return salted_hmac(self.salt, f"{method}:{key}:{expires}").hexdigest()
+
+    def verify(self, method, key, expires, signature):
+        """Verify signature of a pre-signed url or post, which is not expired"""
+        try:
+            expired = int(expires) < time.time()
+        except (TypeError, ValueError):
+            return False
+        return not expired and constant_time_compare(
+            signature, self.sign(method, key, expires)
+        )
+
+    def sign_urls(self, keys, expiry):
+        expires = int(time.time()) + expiry
+        return {
+            key: f"{self.base_url}{quote(key)}?"
+            + urlencode(
+                {"expires": expires, "signature": self.sign("GET", key, expires)}
+            )
+            for key in keys
+        }
+
+    def post_key(self, key, content_type, max_size):
+        """Signed name of a pre-signed post, conditions are signed with the key"""
+        return f"{key}?content-type={content_type or ''}&max-size={max_size or ''}"
+
+    def presigned_post(self, key, expiry, content_type=None, max_size=None):
+        expires = int(time.time()) + expiry
+        fields = {"key": key}
+        if content_type:
+            fields["Content-Type"] = content_type
+        if max_size:
+            fields["max-size"] = str(max_size)
+        return {
+            "url": f"{self.base_url}upload",
+            "fields": {
+                **fields,
+                "expires": str(expires),
+                "signature": self.sign(
+                    "POST", self.post_key(key, content_type, max_size), expires
+                ),
+            },
+        }
+
+    def _write(self, path, fileobjs):
+        tmp = os.path.join(self.root, ".tmp")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.makedirs(tmp, exist_ok=True)
+        # Written aside and moved in place, readers never see a partly written file
+        with NamedTemporaryFile(dir=tmp, delete=False) as output:
+            try:
+                for fileobj in fileobjs:
+                    copyfileobj(fileobj, output, settings.AWS_TRANSFER_CHUNK_SIZE)
+            except Exception:
+                os.remove(output.name)
+                raise
+        os.replace(output.name, path)
+
+    def put(self, key, fileobj):
+        self._write(self.path(key), [fileobj])
+
+    def open(self, key):
+        with open(self.path(key), "rb") as fileobj:
+            if not os.fstat(fileobj.fileno()).st_size:
+                # Empty files can't be mapped
+                return BytesIO()
+            return mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read_header(self, key, length):
+        with open(self.path(key), "rb") as fileobj:
+            return fileobj.read(length), os.fstat(fileobj.fileno()).st_size
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def size(self, key):
+        try:
+            return os.path.getsize(self.path(key))
+        except FileNotFoundError:
+            return None
+
+    def delete(self, keys):
+        failed = []
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                failed.append(key)
+        return failed
+
+    def list(self, prefix):
+        # Walk only the deepest directory covering the prefix
+        directory = os.path.dirname(self.path(prefix + "_"))
+        keys = sorted(
+            os.path.relpath(os.path.join(dirpath, filename), self.root)
+            for dirpath, _, filenames in os.walk(directory)
+            for filename in filenames
+        )
+        keys = [
+            key
+            for key in keys
+            if key.startswith(prefix) and not key.startswith(".tmp" + os.sep)
+        ]
+        for start in range(0, len(keys), LIST_PAGE_SIZE):
+            yield keys[start : start + LIST_PAGE_SIZE]
+
+    def upload_path(self, upload_id):
+        """Directory of uploaded parts, under .tmp so parts are never listed"""
+        if not upload_id.isalnum():
+            raise UploadError(f"Unknown upload {upload_id}")
+        return os.path.join(self.root, ".tmp", "multipart", upload_id)
+
+    def _get_upload_path(self, key, upload_id):
+        path = self.upload_path(upload_id)
+        try:
+            with open(os.path.join(path, "key")) as fileobj:
+                if fileobj.read() == key:
+                    return path
+        except FileNotFoundError:
+            pass
+        raise UploadError(f"Unknown upload {upload_id}")
+
+    def part_key(self, key, upload_id, part_number):
+        """Signed name of one part, parts are signed like keys"""
+        return f"{key}?uploadId={upload_id}&partNumber={part_number}"
+
+    def put_part(self, key, upload_id, part_number, fileobj):
+        """Store one part, replacing earlier upload of the same part"""
+        path = self._get_upload_path(key, upload_id)
+        self._write(os.path.join(path, str(part_number)), [fileobj])
+
+    def create_multipart(self, key, content_type):
+        self.path(key)
+        upload_id = uuid4().hex
+        path = self.upload_path(upload_id)
+        os.makedirs(path)
+        with open(os.path.join(path, "key"), "w") as fileobj:
+            fileobj.write(key)
+        return upload_id
+
+    def sign_part_urls(self, key, upload_id, part_numbers, expiry):
+        expires = int(time.time()) + expiry
+        return {
+            part_number: f"{self.base_url}parts/{upload_id}/{part_number}?"
+            + urlencode(
+                {
+                    "key": key,
+                    "expires": expires,
+                    "signature": self.sign(
+                        "PUT", self.part_key(key, upload_id, part_number), expires
+                    ),
+                }
+            )
+            for part_number in part_numbers
+        }
+
+    def list_parts(self, key, upload_id):
+        path = self._get_upload_path(key, upload_id)
+        parts = []
+        for name in sorted(filter(str.isdigit, os.listdir(path)), key=int):
+            digest = hashlib.md5()
+            with open(os.path.join(path, name), "rb") as fileobj:
+                for chunk in iter(
+                    lambda: fileobj.read(settings.AWS_TRANSFER_CHUNK_SIZE), b""
+                ):
+                    digest.update(chunk)
+                parts.append(
+                    {
+                        "part_number": int(name),
+                        "etag": f'"{digest.hexdigest()}"',
+                        "size": fileobj.tell(),
+                    }
+                )
+        return parts
+
+    def complete_multipart(self, key, upload_id, parts):
+        path = self._get_upload_path(key, upload_id)
+        uploaded = {
+            part["part_number"]: part["etag"]
+            for part in self.list_parts(key, upload_id)
+        }
+        if not parts or any(uploaded.get(number) != etag for number, etag in parts):
+            raise UploadError("Parts are missing or changed")
+
+        def read_parts():
+            # One part file open at a time
+            for number, _ in parts:
+                with open(os.path.join(path, str(number)), "rb") as fileobj:
+                    yield fileobj
+
+        self._write(self.path(key), read_parts())
+        rmtree(path)
+
+    def abort_multipart(self, key, upload_id):
+        rmtree(self._get_upload_path(key, upload_id))
@@ -0,0 +1,152 @@
+"""Cache utils."""
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from uuid import uuid4
+
+from django.core.cache import cache
+
+_missing = object()
+
+# All process local caches, to be able to reset them (e.g. in tests)
+_local_caches = []
+
+
+class LocalCache:
+    """Thread safe in process LRU cache, every entry expires after its own timeout."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + timeout)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def clear_local_caches():
+    """Clear every process local cache, shared Django cache is not touched"""
+    for local_cache in _local_caches:
+        local_cache.clear()
+
+
+class TieredCache:
+    """
+    Two level cache, process local LRU in front of the Django cache (Redis).
+    Local entries live at most `local_timeout` seconds, so deletes done by other
+    processes are seen after that.
+    """
+
+    def __init__(self, prefix, maxsize=1024, local_timeout=60):
+        self.prefix = prefix
+        self.local = LocalCache(maxsize)
+        self.local_timeout = local_timeout
+        _local_caches.append(self.local)
+
+    def make_key(self, key):
+        return f"{self.prefix}:{key}"
+
+    def get(self, key, default=None):
+        key = self.make_key(key)
+        value = self.local.get(key, _missing)
+        if value is _missing:
+            # Shared entries keep their expiry time, local copy never outlives it
+            value, expires = cache.get(key, (_missing, 0))
+            remaining = expires - time.time()
+            if value is _missing or remaining <= 0:
+                return default
+            self.local.set(key, value, min(remaining, self.local_timeout))
+        return value
+
+    def set(self, key, value, timeout):
+        if not timeout:
+            return self.delete(key)
+        key = self.make_key(key)
+        self.local.set(key, value, min(timeout, self.local_timeout))
+        cache.set(key, (value, time.time() + timeout), timeout)
+
+    def get_many(self, keys):
+        """Found values by key, shared cache is asked once for all local misses"""
+        found = {}
+        shared = {}
+        for key in keys:
+            value = self.local.get(self.make_key(key), _missing)
+            if value is _missing:
+                shared[self.make_key(key)] = key
+            else:
+                found[key] = value
+
+        if shared:
+            now = time.time()
+            for cache_key, (value, expires) in cache.get_many(list(shared)).items():
+                remaining = expires - now
+                if remaining > 0:
+                    self.local.set(cache_key, value, min(remaining, self.local_timeout))
+                    found[shared[cache_key]] = value
+        return found
+
+    def set_many(self, data, timeout):
+        if not timeout:
+            return
+        expires = time.time() + timeout
+        items = {}
+        for key, value in data.items():
+            cache_key = self.make_key(key)
+            self.local.set(cache_key, value, min(timeout, self.local_timeout))
+            items[cache_key] = (value, expires)
+        cache.set_many(items, timeout)
+
+    def delete(self, key):
+        key = self.make_key(key)
+        self.local.delete(key)
+        cache.delete(key)
+
+    def delete_many(self, keys):
+        keys = [self.make_key(key) for key in keys]
+        for key in keys:
+            self.local.delete(key)
+        cache.delete_many(keys)
+
+
+@contextmanager
+def single_flight(key, timeout=300):
+    """
+    Lock shared by all processes through the Django cache (Redis), yields True
+    to the only holder. Others get False and should skip the work. Lock expires
+    after timeout, if holder dies before releasing it. If the cache is down, every
+    caller gets True: work may be done twice, but is never skipped.
+    """
+    key = f"single-flight:{key}"
+    token = uuid4().hex
+    acquired = cache.add(key, token, timeout)
+    try:
+        # None (not False) when redis errors are ignored, see IGNORE_EXCEPTIONS
+        yield acquired is not False
+    finally:
+        if acquired and cache.get(key) == token:
+            cache.delete(key)
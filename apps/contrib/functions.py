@@ -0,0 +1,9 @@
+"""Database functions."""
+from django.db.models import Func
+
+
+class ArrayAppend(Func):
+    """Postgres array_append, adds a value to the end of an array field"""
+
+    function = "array_append"
+    arity = 2
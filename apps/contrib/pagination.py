@@ -0,0 +1,87 @@
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Keyset pagination over a descending (timestamp, unique id) ordering.
+    Pages are fetched with `WHERE (created_at, id) < (cursor)` instead of
+    OFFSET and without COUNT(*), so every page costs the same using the
+    composite index, no matter how deep it is.
+    """
+
+    ordering = ("-created_at", "-id")
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor.reverse
+        fields = [field.lstrip("-") for field in self.ordering]
+
+        if reverse:
+            queryset = queryset.order_by(*fields)
+        else:
+            queryset = queryset.order_by(*self.ordering)
+
+        if self.cursor is not None and self.cursor.position is not None:
+            queryset = queryset.filter(
+                self._get_keyset_filter(queryset.model, fields, reverse)
+            )
+
+        results = list(queryset[: self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[: self.page_size]
+        if reverse:
+            self.page.reverse()
+
+        # Coming from a cursor means there are items on the other side
+        if reverse:
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor is not None
+        return self.page
+
+    def _get_keyset_filter(self, model, fields, reverse):
+        try:
+            values = self.cursor.position.split("|")
+            first, second = (
+                model._meta.get_field(field).to_python(value)
+                for field, value in zip(fields, values)
+            )
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+        # Range on the first field keeps the filter usable by the index
+        lookup = "gt" if reverse else "lt"
+        return Q(**{f"{fields[0]}__{lookup}e": first}) & (
+            Q(**{f"{fields[0]}__{lookup}": first})
+            | Q(**{f"{fields[1]}__{lookup}": second})
+        )
+
+    def _get_position(self, instance):
+        return "|".join(
+            instance._meta.get_field(field.lstrip("-")).value_to_string(instance)
+            for field in self.ordering
+        )
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        cursor = Cursor(
+            offset=0, reverse=False, position=self._get_position(self.page[-1])
+        )
+        return self.encode_cursor(cursor)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        cursor = Cursor(
+            offset=0, reverse=True, position=self._get_position(self.page[0])
+        )
+        return self.encode_cursor(cursor)
@@ -1,7 +1,13 @@
-from rest_framework.fields import CharField, URLField, DictField
+from rest_framework.fields import CharField, URLField, DictField, ListField
 from rest_framework.serializers import ModelSerializer, Serializer
 
 
 class PresignedPostURLSerializer(Serializer):
     url = URLField()
     fields = DictField(child=CharField())
+
+
+class S3EventSerializer(Serializer):
+    """S3 / MinIO bucket event notification"""
+
+    Records = ListField(child=DictField(), default=list)
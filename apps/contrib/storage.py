@@ -1,22 +1,92 @@
-"""S3 utils."""
+"""Storage utils, objects are stored in S3 by default (STORAGE_BACKEND)."""
+import asyncio
+import hashlib
 import hmac
-from tempfile import NamedTemporaryFile
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from itertools import islice
+from shutil import copyfileobj
+from tempfile import SpooledTemporaryFile
+from urllib.parse import quote, unquote_plus, urlsplit
 
-from boto3 import resource
 from boto3 import session as _session
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 from django.conf import settings
+from django.utils.module_loading import import_string
+
+from apps.contrib.backends import StorageBackend, UploadError
+from apps.contrib.cache import TieredCache
 
 session = _session.Session(region_name=settings.AWS_BUCKET_REGION)
 
-s3 = session.client(
-    "s3",
-    endpoint_url=settings.AWS_S3_ENDPOINT_URL,
-    aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-    config=_session.Config(signature_version="s3v4"),
+
+def create_client():
+    """S3 client with tuned connection pool, retries and timeouts"""
+    config = _session.Config(
+        signature_version="s3v4",
+        max_pool_connections=settings.AWS_MAX_POOL_CONNECTIONS,
+        retries={
+            "mode": settings.AWS_RETRY_MODE,
+            "max_attempts": settings.AWS_MAX_ATTEMPTS,
+        },
+        connect_timeout=settings.AWS_CONNECT_TIMEOUT,
+        read_timeout=settings.AWS_READ_TIMEOUT,
+        s3={"addressing_style": settings.AWS_S3_ADDRESSING_STYLE or "auto"},
+    )
+    return session.client(
+        "s3",
+        endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+        config=config,
+    )
+
+
+# One client per process, boto3 clients are thread safe
+s3 = create_client()
+
+# Managed uploads, files over the threshold are uploaded in parallel parts
+transfer_config = TransferConfig(
+    multipart_threshold=settings.AWS_MULTIPART_THRESHOLD,
+    multipart_chunksize=settings.AWS_MULTIPART_CHUNK_SIZE,
+    max_concurrency=settings.AWS_MULTIPART_CONCURRENCY,
 )
 
+# Object existence by key, filled by HEAD requests and updated on writes
+exists_cache = TieredCache("s3-exists", maxsize=4096)
+
+# Pre-signed GET urls by key and expiry, reused for a part of their lifetime
+presigned_url_cache = TieredCache("s3-presigned-url", maxsize=4096)
+
+# Maximum keys of a DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+
+# Errors of multipart requests caused by the upload or its parts, not by S3
+MULTIPART_ERRORS = {"NoSuchUpload", "InvalidPart", "InvalidPartOrder", "EntityTooSmall"}
+
+# Blocking S3 (and cache, broker) calls of async views run here, off the event loop
+executor = ThreadPoolExecutor(
+    max_workers=settings.AWS_ASYNC_MAX_WORKERS, thread_name_prefix="s3"
+)
+
+
+def _after_fork():
+    """
+    Forked processes (celery prefork, gunicorn workers) get their own client and
+    thread pool, connections and threads of the parent are not shared.
+    """
+    global s3, executor
+    s3 = create_client()
+    executor = ThreadPoolExecutor(
+        max_workers=settings.AWS_ASYNC_MAX_WORKERS, thread_name_prefix="s3"
+    )
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
 
 def _get_digest(msg):
     result = hmac.new(
@@ -27,18 +97,267 @@ def _get_digest(msg):
     return result.hexdigest()
 
 
-def generate_presigned_url(key):
-    """Generate presigned GET url."""
+def _sign_url(key, expiry):
     return s3.generate_presigned_url(
         "get_object",
         Params={"Bucket": settings.AWS_BUCKET_NAME, "Key": key},
-        ExpiresIn=settings.AWS_EXPIRY,
+        ExpiresIn=expiry,
+    )
+
+
+@lru_cache(maxsize=8)
+def _get_signing_key(secret_key, date, region):
+    """SigV4 signing key, only changes once a day"""
+    key = f"AWS4{secret_key}".encode("utf-8")
+    for msg in (date, region, "s3", "aws4_request"):
+        key = hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+    return key
+
+
+def _sign_urls(keys, expiry):
+    """
+    SigV4 query string signing of GET urls, same as s3.generate_presigned_url.
+    Only the first key is signed by boto3, the url layout (endpoint, addressing
+    style) is taken from it and the rest are signed with a shared signing key.
+    """
+    first, *keys = keys
+    url = _sign_url(first, expiry)
+    urls = {first: url}
+
+    base = url.split("?")[0]
+    quoted = quote(first, safe="/~")
+    if s3.meta.config.signature_version != "s3v4" or not base.endswith(quoted):
+        # Unknown signature or url layout, sign one by one
+        urls.update({key: _sign_url(key, expiry) for key in keys})
+        return urls
+
+    parts = urlsplit(base[: -len(quoted)])
+    timestamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+    scope = f"{timestamp[:8]}/{s3.meta.region_name}/s3/aws4_request"
+    signing_key = _get_signing_key(
+        settings.AWS_SECRET_ACCESS_KEY, timestamp[:8], s3.meta.region_name
     )
+    params = {
+        "X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+        "X-Amz-Credential": f"{settings.AWS_ACCESS_KEY_ID}/{scope}",
+        "X-Amz-Date": timestamp,
+        "X-Amz-Expires": str(expiry),
+        "X-Amz-SignedHeaders": "host",
+    }
+    query = "&".join(
+        f"{name}={quote(value, safe='-_.~')}" for name, value in sorted(params.items())
+    )
+
+    for key in keys:
+        path = parts.path + quote(key, safe="/~")
+        canonical_request = "\n".join(
+            ("GET", path, query, f"host:{parts.netloc}", "", "host", "UNSIGNED-PAYLOAD")
+        )
+        string_to_sign = "\n".join(
+            (
+                "AWS4-HMAC-SHA256",
+                timestamp,
+                scope,
+                hashlib.sha256(canonical_request.encode("utf-8")).hexdigest(),
+            )
+        )
+        signature = hmac.new(
+            signing_key, string_to_sign.encode("utf-8"), hashlib.sha256
+        ).hexdigest()
+        urls[
+            key
+        ] = f"{parts.scheme}://{parts.netloc}{path}?{query}&X-Amz-Signature={signature}"
+    return urls
+
+
+class S3Backend(StorageBackend):
+    """Objects in AWS_BUCKET_NAME bucket of S3 (or MinIO), with the process s3 client"""
+
+    def sign_urls(self, keys, expiry):
+        return _sign_urls(keys, expiry)
+
+    def presigned_post(self, key, expiry, content_type=None, max_size=None):
+        # Policy conditions are enforced by S3, rejected uploads never reach the bucket
+        fields, conditions = {}, []
+        if content_type:
+            fields["Content-Type"] = content_type
+            conditions.append({"Content-Type": content_type})
+        if max_size:
+            conditions.append(["content-length-range", 1, max_size])
+        return s3.generate_presigned_post(
+            settings.AWS_BUCKET_NAME,
+            key,
+            Fields=fields,
+            Conditions=conditions,
+            ExpiresIn=expiry,
+        )
+
+    def put(self, key, fileobj):
+        s3.upload_fileobj(
+            fileobj, settings.AWS_BUCKET_NAME, key, Config=transfer_config
+        )
+
+    def open(self, key):
+        # Object body is streamed in chunks
+        fileobj = spooled_fileobj()
+        body = s3.get_object(Bucket=settings.AWS_BUCKET_NAME, Key=key)["Body"]
+        try:
+            copyfileobj(body, fileobj, settings.AWS_TRANSFER_CHUNK_SIZE)
+        except Exception:
+            fileobj.close()
+            raise
+        finally:
+            body.close()
+        fileobj.seek(0)
+        return fileobj
+
+    def read_header(self, key, length):
+        # Ranged GET, only the header bytes are transferred
+        try:
+            response = s3.get_object(
+                Bucket=settings.AWS_BUCKET_NAME, Key=key, Range=f"bytes=0-{length - 1}"
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "InvalidRange":
+                raise
+            # Empty object
+            return b"", 0
+        with response["Body"] as body:
+            header = body.read()
+        if "ContentRange" in response:
+            return header, int(response["ContentRange"].split("/")[-1])
+        return header, response["ContentLength"]
+
+    def exists(self, key):
+        return self.size(key) is not None
+
+    def size(self, key):
+        try:
+            response = s3.head_object(Bucket=settings.AWS_BUCKET_NAME, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                raise
+            return None
+        return response["ContentLength"]
+
+    def delete(self, keys):
+        response = s3.delete_objects(
+            Bucket=settings.AWS_BUCKET_NAME,
+            Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+        )
+        return [error["Key"] for error in response.get("Errors", [])]
+
+    def list(self, prefix):
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=settings.AWS_BUCKET_NAME, Prefix=prefix):
+            yield [obj["Key"] for obj in page.get("Contents", [])]
+
+    def create_multipart(self, key, content_type):
+        return s3.create_multipart_upload(
+            Bucket=settings.AWS_BUCKET_NAME, Key=key, ContentType=content_type
+        )["UploadId"]
+
+    def sign_part_urls(self, key, upload_id, part_numbers, expiry):
+        return {
+            part_number: s3.generate_presigned_url(
+                "upload_part",
+                Params={
+                    "Bucket": settings.AWS_BUCKET_NAME,
+                    "Key": key,
+                    "UploadId": upload_id,
+                    "PartNumber": part_number,
+                },
+                ExpiresIn=expiry,
+            )
+            for part_number in part_numbers
+        }
 
+    def list_parts(self, key, upload_id):
+        paginator = s3.get_paginator("list_parts")
+        try:
+            return [
+                {
+                    "part_number": part["PartNumber"],
+                    "etag": part["ETag"],
+                    "size": part["Size"],
+                }
+                for page in paginator.paginate(
+                    Bucket=settings.AWS_BUCKET_NAME, Key=key, UploadId=upload_id
+                )
+                for part in page.get("Parts", [])
+            ]
+        except ClientError as e:
+            raise _upload_error(e)
 
-def generate_presigned_post(key):
-    """Generate presigned POST url."""
-    d = s3.generate_presigned_post(settings.AWS_BUCKET_NAME, key, ExpiresIn=300)
+    def complete_multipart(self, key, upload_id, parts):
+        try:
+            s3.complete_multipart_upload(
+                Bucket=settings.AWS_BUCKET_NAME,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={
+                    "Parts": [
+                        {"PartNumber": number, "ETag": etag} for number, etag in parts
+                    ]
+                },
+            )
+        except ClientError as e:
+            raise _upload_error(e)
+
+    def abort_multipart(self, key, upload_id):
+        try:
+            s3.abort_multipart_upload(
+                Bucket=settings.AWS_BUCKET_NAME, Key=key, UploadId=upload_id
+            )
+        except ClientError as e:
+            raise _upload_error(e)
+
+
+def _upload_error(error):
+    """UploadError of multipart errors caused by the client, others are raised as is"""
+    if error.response["Error"]["Code"] in MULTIPART_ERRORS:
+        return UploadError(error.response["Error"].get("Message", str(error)))
+    return error
+
+
+backend = import_string(settings.STORAGE_BACKEND)()
+
+
+def generate_presigned_urls(keys):
+    """
+    Generate presigned GET urls for many keys in one pass, returns urls by key.
+    Signed urls are cached and reused until AWS_PRESIGNED_URL_REUSE fraction of
+    AWS_EXPIRY has passed, so every url is still valid for the remaining time.
+    """
+    expiry = settings.AWS_EXPIRY
+    cache_keys = {f"{expiry}:{key}": key for key in keys}
+    urls = {
+        cache_keys[cache_key]: url
+        for cache_key, url in presigned_url_cache.get_many(cache_keys).items()
+    }
+
+    missing = [key for key in cache_keys.values() if key not in urls]
+    if missing:
+        signed = backend.sign_urls(missing, expiry)
+        presigned_url_cache.set_many(
+            {f"{expiry}:{key}": url for key, url in signed.items()},
+            int(expiry * settings.AWS_PRESIGNED_URL_REUSE),
+        )
+        urls.update(signed)
+    return urls
+
+
+def generate_presigned_url(key):
+    """Generate presigned GET url."""
+    return generate_presigned_urls([key])[key]
+
+
+def generate_presigned_post(key, content_type=None, max_size=None):
+    """
+    Generate presigned POST url. Uploads must have the content type and
+    at most max_size bytes, if given.
+    """
+    d = backend.presigned_post(key, 300, content_type, max_size)
     d.update({"digest": _get_digest(key)})
     return d
 
@@ -48,28 +367,142 @@ def verify_digest(key, digest):
     return hmac.compare_digest(digest, _get_digest(key))
 
 
-def delete_objects(key):
-    """Delete objects from bucket."""
-    s3 = resource("s3")
-    object = s3.Object(settings.AWS_BUCKET_NAME, key)
-    return object.delete()
+def delete_objects(keys):
+    """
+    Delete objects from bucket, up to DELETE_BATCH_SIZE keys per request.
+    Keys can be any iterable, e.g. list_keys pages. Returns keys failed to delete
+    """
+    keys = iter(keys)
+    failed = []
+    while True:
+        batch = list(islice(keys, DELETE_BATCH_SIZE))
+        if not batch:
+            return failed
+        failed.extend(backend.delete(batch))
+        exists_cache.delete_many(batch)
+
+
+def create_multipart_upload(key, content_type):
+    """Start a multipart upload, parts are uploaded with pre-signed part urls"""
+    return backend.create_multipart(key, content_type)
+
+
+def generate_presigned_part_urls(key, upload_id, part_numbers):
+    """Generate presigned PUT urls of parts by part number."""
+    return backend.sign_part_urls(
+        key, upload_id, part_numbers, settings.AWS_MULTIPART_UPLOAD_EXPIRY
+    )
+
+
+def list_uploaded_parts(key, upload_id):
+    """Parts uploaded so far, an interrupted upload resumes from the missing parts"""
+    return backend.list_parts(key, upload_id)
+
+
+def complete_multipart_upload(key, upload_id, max_size=None):
+    """
+    Combine all uploaded parts into the key. Raises UploadError if upload is unknown,
+    has no parts, parts are too small or over max_size bytes in total.
+    """
+    parts = list_uploaded_parts(key, upload_id)
+    if not parts:
+        raise UploadError("No parts uploaded")
+    if max_size and sum(part["size"] for part in parts) > max_size:
+        raise UploadError(f"Maximum file size is {max_size} bytes")
+    backend.complete_multipart(
+        key, upload_id, [(part["part_number"], part["etag"]) for part in parts]
+    )
+    exists_cache.set(key, True, settings.AWS_EXISTS_CACHE_TIMEOUT)
+
+
+def abort_multipart_upload(key, upload_id):
+    """Abort multipart upload, uploaded parts are deleted"""
+    backend.abort_multipart(key, upload_id)
 
 
 def upload_fileobj(key, file_obj):
     """Upload file from server"""
-    return s3.upload_fileobj(file_obj, settings.AWS_BUCKET_NAME, key)
+    result = backend.put(key, file_obj)
+    exists_cache.set(key, True, settings.AWS_EXISTS_CACHE_TIMEOUT)
+    return result
+
+
+def spooled_fileobj():
+    """
+    Temporary file object, kept in memory until AWS_SPOOL_MAX_SIZE bytes and
+    rolled over to disk after that. Removed when closed.
+    """
+    return SpooledTemporaryFile(max_size=settings.AWS_SPOOL_MAX_SIZE)
 
 
 def download_fileobj(key):
-    """Download file from bucket as object"""
-    fileobj = NamedTemporaryFile(delete=False)
-    s3.download_fileobj(settings.AWS_BUCKET_NAME, key, fileobj)
-    fileobj.seek(0)
-    return fileobj
+    """
+    Download file from bucket as object, without reading it all in memory.
+    Close the file object (or use it as a context manager) when done.
+    """
+    return backend.open(key)
+
+
+def read_header(key, length):
+    """First length bytes of the object (or less) and its full size in bytes"""
+    return backend.read_header(key, length)
 
 
 def check_file_exists(key):
-    result = s3.list_objects_v2(Bucket=settings.AWS_BUCKET_NAME, Prefix=key)
-    if "Contents" in result:
-        return True
-    return False
+    """
+    Check object exists for the exact key, e.g. with a HEAD request.
+    Results are cached, missing objects only for AWS_EXISTS_NEGATIVE_CACHE_TIMEOUT
+    as those can be uploaded with a pre-signed post at any time.
+    """
+    exists = exists_cache.get(key)
+    if exists is not None:
+        return exists
+
+    exists = backend.exists(key)
+    if exists:
+        exists_cache.set(key, exists, settings.AWS_EXISTS_CACHE_TIMEOUT)
+    else:
+        exists_cache.set(key, exists, settings.AWS_EXISTS_NEGATIVE_CACHE_TIMEOUT)
+    return exists
+
+
+def get_file_size(key):
+    """Object size in bytes with a HEAD request, None if object doesn't exist"""
+    size = backend.size(key)
+    if size is not None:
+        exists_cache.set(key, True, settings.AWS_EXISTS_CACHE_TIMEOUT)
+    return size
+
+
+async def run_async(func, *args):
+    """Await a blocking S3 call, run in the storage thread pool"""
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+async def acheck_file_exists(key):
+    """Async check_file_exists, for async views"""
+    return await run_async(check_file_exists, key)
+
+
+def list_keys(prefix):
+    """Keys of the bucket under the prefix, yields pages of up to 1000 keys"""
+    return backend.list(prefix)
+
+
+def get_event_keys(records, event_name="ObjectCreated"):
+    """
+    Object keys of the bucket from S3 (or MinIO) event notification records,
+    for the given event type, e.g. `ObjectCreated` for s3:ObjectCreated:Put/Post.
+    """
+    keys = []
+    for record in records:
+        if event_name not in record.get("eventName", "").split(":"):
+            continue
+        s3_entity = record.get("s3", {})
+        if s3_entity.get("bucket", {}).get("name") != settings.AWS_BUCKET_NAME:
+            continue
+        key = s3_entity.get("object", {}).get("key")
+        if key:
+            # Keys are url encoded in notifications
+            keys.append(unquote_plus(key))
+    return keys
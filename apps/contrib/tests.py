@@ -1,3 +1,161 @@
-from django.test import TestCase
+import time
+from tempfile import TemporaryDirectory
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from rest_framework import status
+
+from apps.contrib import storage
+from apps.contrib.backends import FileSystemBackend, UploadError
+from apps.contrib.cache import clear_local_caches
+from apps.contrib.storage import (
+    abort_multipart_upload,
+    check_file_exists,
+    complete_multipart_upload,
+    create_multipart_upload,
+    delete_objects,
+    download_fileobj,
+    generate_presigned_part_urls,
+    generate_presigned_post,
+    generate_presigned_url,
+    list_keys,
+    list_uploaded_parts,
+    upload_fileobj,
+)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    AWS_EXISTS_NEGATIVE_CACHE_TIMEOUT=0,
+)
+class FileSystemBackendTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        clear_local_caches()
+
+        # Hermetic storage, no S3 needed
+        self.root = TemporaryDirectory()
+        self.backend = FileSystemBackend(root=self.root.name, base_url="/storage/")
+        patcher = mock.patch.object(storage, "backend", self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.root.cleanup)
+
+    def test_objects(self):
+        """
+        Test put, memory mapped read, exists, list and delete of objects
+        """
+        with open("data/images/car.jpg", "rb") as fileobj:
+            content = fileobj.read()
+            fileobj.seek(0)
+            upload_fileobj("images/1/car.jpg", fileobj)
+        upload_fileobj("images/2/car.jpg", SimpleUploadedFile("car.jpg", b""))
+
+        with download_fileobj("images/1/car.jpg") as fileobj:
+            self.assertEqual(fileobj.read(), content)
+        with download_fileobj("images/2/car.jpg") as fileobj:
+            self.assertEqual(fileobj.read(), b"")
+
+        self.assertTrue(check_file_exists("images/1/car.jpg"))
+        self.assertFalse(check_file_exists("images/1/car.png"))
+        self.assertEqual(
+            list(list_keys("images/")), [["images/1/car.jpg", "images/2/car.jpg"]]
+        )
+        self.assertEqual(list(list_keys("images/1")), [["images/1/car.jpg"]])
+
+        self.assertEqual(delete_objects(["images/1/car.jpg", "images/1/car.png"]), [])
+        self.assertFalse(check_file_exists("images/1/car.jpg"))
+        self.assertEqual(list(list_keys("images/")), [["images/2/car.jpg"]])
+
+        with self.assertRaises(SuspiciousFileOperation):
+            check_file_exists("../car.jpg")
+
+    def test_presigned_url(self):
+        """
+        Test files are served with pre-signed urls only
+        """
+        upload_fileobj("images/1/car.jpg", SimpleUploadedFile("car.jpg", b"car"))
+
+        url = generate_presigned_url("images/1/car.jpg")
+        request = self.client.get(url)
+        self.assertEqual(request.status_code, status.HTTP_200_OK)
+        self.assertEqual(b"".join(request.streaming_content), b"car")
+        self.assertEqual(request["Content-Type"], "image/jpeg")
+
+        request = self.client.get(url.replace("car.jpg", "car.png"))
+        self.assertEqual(request.status_code, status.HTTP_403_FORBIDDEN)
+
+        with mock.patch("time.time", return_value=time.time() + 10**7):
+            request = self.client.get(url)
+        self.assertEqual(request.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_presigned_post(self):
+        """
+        Test files are uploaded with pre-signed posts
+        """
+        post = generate_presigned_post("images/1/car.jpg")
+        self.assertIn("digest", post)
+
+        request = self.client.post(
+            post["url"], {**post["fields"], "key": "images/2/car.jpg"}
+        )
+        self.assertEqual(request.status_code, status.HTTP_403_FORBIDDEN)
+
+        with open("data/images/car.jpg", "rb") as fileobj:
+            request = self.client.post(post["url"], {**post["fields"], "file": fileobj})
+        self.assertEqual(request.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertTrue(check_file_exists("images/1/car.jpg"))
+
+        # Size and content type conditions are signed with the key
+        post = generate_presigned_post("images/2/car.jpg", "image/jpeg", 1024)
+        self.assertEqual(post["fields"]["Content-Type"], "image/jpeg")
+        with open("data/images/car.jpg", "rb") as fileobj:
+            request = self.client.post(
+                post["url"], {**post["fields"], "max-size": 10**9, "file": fileobj}
+            )
+        self.assertEqual(request.status_code, status.HTTP_403_FORBIDDEN)
+        with open("data/images/car.jpg", "rb") as fileobj:
+            request = self.client.post(post["url"], {**post["fields"], "file": fileobj})
+        self.assertEqual(request.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(check_file_exists("images/2/car.jpg"))
+
+    def test_multipart_upload(self):
+        """
+        Test multipart uploads with pre-signed part urls, completed in part order
+        """
+        upload_id = create_multipart_upload("images/1/car.jpg", "image/jpeg")
+        urls = generate_presigned_part_urls("images/1/car.jpg", upload_id, [1, 2])
+
+        request = self.client.put(urls[2], b"part2")
+        self.assertEqual(request.status_code, status.HTTP_200_OK)
+        request = self.client.put(urls[2].replace("/2?", "/3?"), b"part3")
+        self.assertEqual(request.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(
+            [
+                part["part_number"]
+                for part in list_uploaded_parts("images/1/car.jpg", upload_id)
+            ],
+            [2],
+        )
+        self.client.put(urls[1], b"part1")
+
+        complete_multipart_upload("images/1/car.jpg", upload_id)
+        with download_fileobj("images/1/car.jpg") as fileobj:
+            self.assertEqual(fileobj.read(), b"part1part2")
+        self.assertEqual(list(list_keys("")), [["images/1/car.jpg"]])
+        with self.assertRaises(UploadError):
+            list_uploaded_parts("images/1/car.jpg", upload_id)
+
+        # Aborted uploads leave nothing behind, upload ids are bound to their key
+        upload_id = create_multipart_upload("images/2/car.jpg", "image/jpeg")
+        with self.assertRaises(UploadError):
+            abort_multipart_upload("images/1/car.jpg", upload_id)
+        with self.assertRaises(UploadError):
+            complete_multipart_upload("images/2/car.jpg", upload_id)
+        abort_multipart_upload("images/2/car.jpg", upload_id)
+        self.assertFalse(check_file_exists("images/2/car.jpg"))
+        with self.assertRaises(UploadError):
+            abort_multipart_upload("images/2/car.jpg", "../../images")
@@ -0,0 +1,13 @@
+from django.urls import path
+
+from apps.contrib import views
+
+urlpatterns = [
+    path("upload", views.storage_upload, name="storage-upload"),
+    path(
+        "parts/<str:upload_id>/<int:part_number>",
+        views.storage_upload_part,
+        name="storage-upload-part",
+    ),
+    path("<path:key>", views.storage_file, name="storage-file"),
+]
@@ -1,3 +1,79 @@
-from django.shortcuts import render
+import mimetypes
 
-# Create your views here.
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseForbidden
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import (
+    require_GET,
+    require_http_methods,
+    require_POST,
+)
+
+from apps.contrib import storage
+from apps.contrib.backends import FileSystemBackend, UploadError
+
+
+def _get_backend():
+    if not isinstance(storage.backend, FileSystemBackend):
+        raise Http404()
+    return storage.backend
+
+
+@require_GET
+def storage_file(request, key):
+    """Serve a file of the file system storage with a pre-signed url"""
+    backend = _get_backend()
+    if not backend.verify(
+        "GET", key, request.GET.get("expires"), request.GET.get("signature", "")
+    ):
+        return HttpResponseForbidden()
+    try:
+        fileobj = open(backend.path(key), "rb")
+    except FileNotFoundError:
+        raise Http404()
+    return FileResponse(fileobj, content_type=mimetypes.guess_type(key)[0])
+
+
+@csrf_exempt
+@require_POST
+def storage_upload(request):
+    """Upload a file to the file system storage with a pre-signed post"""
+    backend = _get_backend()
+    key = request.POST.get("key", "")
+    content_type = request.POST.get("Content-Type")
+    max_size = request.POST.get("max-size")
+    if not backend.verify(
+        "POST",
+        backend.post_key(key, content_type, max_size),
+        request.POST.get("expires"),
+        request.POST.get("signature", ""),
+    ):
+        return HttpResponseForbidden()
+    if "file" not in request.FILES:
+        return HttpResponse("File is required", status=400)
+    fileobj = request.FILES["file"]
+    # Same content-length-range condition as S3 policies
+    if max_size and not 0 < fileobj.size <= int(max_size):
+        return HttpResponse("File size isn't allowed by the policy", status=400)
+    storage.upload_fileobj(key, fileobj)
+    return HttpResponse(status=204)
+
+
+@csrf_exempt
+@require_http_methods(["PUT"])
+def storage_upload_part(request, upload_id, part_number):
+    """Upload a part of a multipart upload, with a pre-signed part url"""
+    backend = _get_backend()
+    key = request.GET.get("key", "")
+    if not backend.verify(
+        "PUT",
+        backend.part_key(key, upload_id, part_number),
+        request.GET.get("expires"),
+        request.GET.get("signature", ""),
+    ):
+        return HttpResponseForbidden()
+    try:
+        # Request body is streamed into the part file
+        backend.put_part(key, upload_id, part_number, request)
+    except UploadError:
+        raise Http404()
+    return HttpResponse(status=200)
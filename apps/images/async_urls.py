@@ -0,0 +1,14 @@
+from django.urls import path
+
+from apps.images import async_views
+
+urlpatterns = [
+    path("upload", async_views.image_upload, name="async-image-upload"),
+    path("<uuid:pk>/", async_views.image_retrieve, name="async-image-detail"),
+    path("<uuid:pk>/wait/", async_views.image_wait, name="async-image-wait"),
+    path(
+        "<uuid:pk>/upload-finished/",
+        async_views.image_upload_finished,
+        name="async-image-upload-finished",
+    ),
+]
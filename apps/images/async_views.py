@@ -0,0 +1,162 @@
+"""
+Async image endpoints for ASGI deployments (e.g. uvicorn), same responses as the
+API views. S3, cache and broker calls run in the storage thread pool and queries
+in Django's sync thread, so one worker keeps many S3 round-trips in flight.
+"""
+import asyncio
+import json
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponseNotAllowed, HttpResponseNotModified, JsonResponse
+from rest_framework import status
+
+from apps.contrib.storage import acheck_file_exists, run_async
+from apps.images.cache import get_responses, set_responses
+from apps.images.choices import UploadStatus
+from apps.images.events import get_listener
+from apps.images.models import Image
+from apps.images.serializers import (
+    ImageRetrieveQuerySerializer,
+    ImageSerializer,
+    ImageUploadSerializer,
+    ImageWaitQuerySerializer,
+)
+from apps.images.tasks import queue_uploaded_images
+from apps.images.views import build_image_response, is_not_modified
+
+
+def async_view(*methods):
+    """Allow only the given HTTP methods, views are CSRF exempt like API views"""
+
+    def decorator(view):
+        @wraps(view)
+        async def wrapped(request, *args, **kwargs):
+            if request.method not in methods:
+                return HttpResponseNotAllowed(methods)
+            return await view(request, *args, **kwargs)
+
+        wrapped.csrf_exempt = True
+        return wrapped
+
+    return decorator
+
+
+def _get_data(serializer):
+    # Pre-signed urls are looked up in the cache, serialize off the event loop
+    return serializer.data
+
+
+@sync_to_async
+def _get_image(pk):
+    return Image.objects.filter(pk=pk).first()
+
+
+def _not_found():
+    return JsonResponse({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+
+@async_view("POST")
+async def image_upload(request):
+    """Async version of upload endpoint, creates a s3 presigned post url"""
+    try:
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        return JsonResponse(
+            {"detail": "JSON parse error"}, status=status.HTTP_400_BAD_REQUEST
+        )
+
+    serializer = ImageUploadSerializer(data=data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    await sync_to_async(serializer.save)()
+    return JsonResponse(
+        await run_async(_get_data, serializer), status=status.HTTP_201_CREATED
+    )
+
+
+@async_view("GET")
+async def image_retrieve(request, pk):
+    """Async version of image details endpoint, including extension conversion"""
+    query_serializer = ImageRetrieveQuerySerializer(data=request.GET)
+    if not query_serializer.is_valid():
+        return JsonResponse(query_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    extension = query_serializer.data.get("extension") or ""
+
+    version, responses = await run_async(get_responses, pk)
+    if extension not in responses:
+        instance = await _get_image(pk)
+        if instance is None:
+            return _not_found()
+        responses[extension] = await run_async(
+            build_image_response, instance, extension
+        )
+        await run_async(set_responses, pk, version, responses)
+
+    status_code, data, etag = responses[extension]
+    if is_not_modified(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse(data, status=status_code)
+    response["ETag"] = etag
+    return response
+
+
+@async_view("PATCH")
+async def image_upload_finished(request, pk):
+    """Async version of upload finished endpoint, sets image status to uploaded"""
+    instance = await _get_image(pk)
+    if instance is None:
+        return _not_found()
+
+    # Update status if file exists
+    if await acheck_file_exists(instance.key):
+        instance.status = UploadStatus.UPLOADED
+        await sync_to_async(instance.save)(update_fields=["status", "updated_at"])
+        await run_async(queue_uploaded_images, [instance.id])
+
+    return JsonResponse(await run_async(_get_data, ImageSerializer(instance)))
+
+
+async def _wait(event, deadline):
+    """Wait for the event until loop time deadline, returns True if it is set"""
+    timeout = deadline - asyncio.get_running_loop().time()
+    try:
+        await asyncio.wait_for(event.wait(), max(timeout, 0))
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+@async_view("GET")
+async def image_wait(request, pk):
+    """
+    Long-poll endpoint, responds with image details when its status is different from
+    ?status= (current status by default) or after ?timeout= seconds. Waits are woken by
+    image change notifications, an idle wait holds no thread or database connection.
+    """
+    query_serializer = ImageWaitQuerySerializer(data=request.GET)
+    if not query_serializer.is_valid():
+        return JsonResponse(query_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    query_params = query_serializer.validated_data
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + query_params["timeout"]
+    instance = await _get_image(pk)
+    if instance is None:
+        return _not_found()
+    known_status = query_params.get("status", instance.status)
+
+    if instance.status == known_status:
+        listener = get_listener()
+        with listener.watch(str(pk)) as changed:
+            # Changes before the watch and subscription were missed, read again
+            if await _wait(listener.subscribed, deadline):
+                changed.set()
+            while instance.status == known_status and await _wait(changed, deadline):
+                changed.clear()
+                instance = await _get_image(pk)
+                if instance is None:
+                    return _not_found()
+
+    return JsonResponse(await run_async(_get_data, ImageSerializer(instance)))
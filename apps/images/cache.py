@@ -0,0 +1,41 @@
+"""Cache of image detail responses."""
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def _get_keys(image_id):
+    return f"image-response:{image_id}", f"image-response-version:{image_id}"
+
+
+def get_responses(image_id):
+    """
+    Cached responses of the image by extension and current version of the image,
+    in one cache request. Responses cached for an older version are dropped.
+    """
+    response_key, version_key = _get_keys(image_id)
+    found = cache.get_many([response_key, version_key])
+    version = found.get(version_key)
+    cached_version, responses = found.get(response_key, (None, {}))
+    if cached_version != version:
+        responses = {}
+    return version, responses
+
+
+def set_responses(image_id, version, responses):
+    """
+    Cache responses for the version read with get_responses. If image changed
+    meanwhile, version is outdated and these are never served.
+    """
+    response_key, _ = _get_keys(image_id)
+    cache.set(response_key, (version, responses), settings.IMAGE_RESPONSE_CACHE_TIMEOUT)
+
+
+def invalidate_responses(image_ids):
+    """Drop cached responses of changed images, by giving them a new version"""
+    # Versions outlive responses, an evicted version would revive old responses
+    cache.set_many(
+        {_get_keys(image_id)[1]: uuid4().hex for image_id in image_ids},
+        settings.IMAGE_RESPONSE_CACHE_TIMEOUT * 2,
+    )
@@ -8,3 +8,7 @@ class UploadStatus(IntegerChoices):
     PROCESSING = 3, _("Processing")
     PROCESSED = 4, _("Processed")
     ERROR = 5, _("Error")
+
+
+# Images with an uploaded original, conversions and resizes can be queued for these
+CONVERTIBLE_STATUSES = (UploadStatus.UPLOADED, UploadStatus.PROCESSED)
@@ -0,0 +1,154 @@
+"""Image conversion utils."""
+from io import BytesIO
+from shutil import copyfileobj
+
+from django.conf import settings
+from PIL import Image as PILImage, ImageOps
+
+# Pillow encoder for each supported extension
+FORMATS = {
+    "jpg": "JPEG",
+    "jpeg": "JPEG",
+    "png": "PNG",
+}
+
+# Pillow format of each accepted mimetype
+MIMETYPE_FORMATS = {
+    "image/jpg": "JPEG",
+    "image/jpeg": "JPEG",
+    "image/png": "PNG",
+}
+
+# EXIF orientation tag
+ORIENTATION = 0x0112
+
+# Extensions dict for easy mimetype mapping
+MIMETYPES = {
+    "jpg": "image/jpg",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+}
+
+
+class ImageTooLarge(ValueError):
+    """Image has more pixels than IMAGE_MAX_PIXELS, it is never decoded"""
+
+
+def _flatten(image):
+    """JPEG has no alpha channel, paste transparent images over a white background."""
+    if image.mode in ("RGB", "L", "CMYK"):
+        return image
+    image = image.convert("RGBA")
+    background = PILImage.new("RGB", image.size, (255, 255, 255))
+    background.paste(image, mask=image.getchannel("A"))
+    return background
+
+
+def check_pixels(width, height):
+    """Raise ImageTooLarge for images over IMAGE_MAX_PIXELS"""
+    pixels = width * height
+    if pixels > settings.IMAGE_MAX_PIXELS:
+        raise ImageTooLarge(
+            f"Image has {pixels} pixels, maximum is {settings.IMAGE_MAX_PIXELS}"
+        )
+
+
+def open_image(fileobj, size=None):
+    """
+    Open Pillow image, pixels are decoded lazily. Dimensions from the header are
+    checked against IMAGE_MAX_PIXELS before anything is decoded. If size (width,
+    height) is given, JPEGs are decoded at the smallest scale (1/2 to 1/8) still
+    covering it, in either orientation, memory and time drop with the scale squared.
+    """
+    try:
+        image = PILImage.open(fileobj)
+    except PILImage.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+    try:
+        check_pixels(image.width, image.height)
+    except ImageTooLarge:
+        image.close()
+        raise
+    if size and image.format == "JPEG":
+        # EXIF rotation is applied after decoding, box may be rotated
+        side = max(size)
+        image.draft(image.mode, (side, side))
+    return image
+
+
+def read_metadata(fileobj):
+    """
+    Format, dimensions and EXIF orientation from the image header, pixels are not
+    decoded. Raises ImageTooLarge for images over IMAGE_MAX_PIXELS
+    """
+    try:
+        image = PILImage.open(fileobj)
+    except PILImage.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+    with image:
+        # Before anything that could load the pixels
+        check_pixels(image.width, image.height)
+        if image.format == "JPEG":
+            exif = image.getexif()
+        else:
+            # PNG getexif() decodes the pixels without an eXIf chunk before them
+            exif = PILImage.Exif()
+            if "exif" in image.info:
+                exif.load(image.info["exif"])
+        return {
+            "format": image.format,
+            "width": image.width,
+            "height": image.height,
+            "orientation": exif.get(ORIENTATION),
+        }
+
+
+def resize(image, width, height, fit="contain"):
+    """
+    Resize Pillow image into a width x height box, images are never upscaled.
+    contain: whole image fits inside the box,
+    cover: image fills the box, cropped at center
+    """
+    if fit == "cover":
+        scale = min(1, image.width / width, image.height / height)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        return ImageOps.fit(image, size, method=PILImage.LANCZOS)
+
+    image = image.copy()
+    image.thumbnail((width, height), PILImage.LANCZOS)
+    return image
+
+
+def encode(image, extension, output=None, **options):
+    """
+    Encode Pillow image with the given extension format, into output file object.
+    Encoder options from `IMAGE_ENCODER_OPTIONS` settings can be overridden with
+    options.
+    """
+    image_format = FORMATS[extension.lower()]
+    params = {**settings.IMAGE_ENCODER_OPTIONS.get(image_format, {}), **options}
+
+    if output is None:
+        output = BytesIO()
+    if image_format == "JPEG":
+        image = _flatten(image)
+    image.save(output, format=image_format, **params)
+    output.seek(0)
+    return output
+
+
+def convert(fileobj, extension, output=None, **options):
+    """
+    Encode image file object with the given extension format, into output file.
+    EXIF orientation is applied, like in renditions. Files already in that format
+    (e.g. jpg to jpeg) are copied as is, without a lossy encode dropping EXIF/ICC.
+    """
+    with open_image(fileobj) as image:
+        if image.format == FORMATS[extension.lower()] and not options:
+            if output is None:
+                output = BytesIO()
+            fileobj.seek(0)
+            copyfileobj(fileobj, output)
+            output.seek(0)
+            return output
+        return encode(ImageOps.exif_transpose(image), extension, output, **options)
@@ -0,0 +1,98 @@
+"""
+Image change notifications over redis pub/sub. Changes publish image ids on one
+channel, each ASGI worker keeps a single subscription and wakes the requests waiting
+on those images, so thousands of idle waits share one redis connection.
+"""
+import asyncio
+from collections import defaultdict
+from contextlib import contextmanager
+
+import redis
+import redis.asyncio as aioredis
+from celery.utils.log import get_task_logger
+from django.conf import settings
+
+from apps.images.cache import invalidate_responses
+
+logger = get_task_logger(__name__)
+
+# Pub/sub channel of changed image ids, comma separated
+CHANNEL = "image-changes"
+
+# Publisher, connections are reset by redis-py in forked processes
+client = redis.Redis.from_url(settings.IMAGE_EVENTS_URL)
+
+
+def notify_changed(image_ids):
+    """Drop cached responses of changed images and wake clients waiting on them"""
+    image_ids = [str(image_id) for image_id in image_ids]
+    if not image_ids:
+        return
+    invalidate_responses(image_ids)
+    try:
+        client.publish(CHANNEL, ",".join(image_ids))
+    except redis.RedisError as e:
+        # Waiting clients still respond at their timeout
+        logger.warning("Image Events Error: %s", e)
+
+
+class ChangeListener:
+    """Subscription of the running event loop, wakes waiters of published image ids"""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.waiters = defaultdict(set)
+        self.subscribed = asyncio.Event()
+        self.task = self.loop.create_task(self.listen())
+
+    async def listen(self):
+        reconnect = False
+        while True:
+            try:
+                connection = aioredis.Redis.from_url(settings.IMAGE_EVENTS_URL)
+                async with connection.pubsub() as pubsub:
+                    await pubsub.subscribe(CHANNEL)
+                    self.subscribed.set()
+                    if reconnect:
+                        # Changes published while reconnecting were missed, recheck all
+                        self.wake(list(self.waiters))
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self.wake(message["data"].decode().split(","))
+            except (aioredis.RedisError, OSError) as e:
+                logger.warning("Image Events Error: %s", e)
+            self.subscribed.clear()
+            reconnect = True
+            await asyncio.sleep(1)
+
+    def wake(self, image_ids):
+        for image_id in image_ids:
+            for event in self.waiters.get(image_id, ()):
+                event.set()
+
+    @contextmanager
+    def watch(self, image_id):
+        """Event set when the image changes, register before reading the image"""
+        event = asyncio.Event()
+        self.waiters[image_id].add(event)
+        try:
+            yield event
+        finally:
+            self.waiters[image_id].discard(event)
+            if not self.waiters[image_id]:
+                del self.waiters[image_id]
+
+
+_listener = None
+
+
+def get_listener():
+    """Listener of the running event loop, started on first use"""
+    global _listener
+    if (
+        _listener is None
+        or _listener.loop is not asyncio.get_running_loop()
+        or _listener.task.done()
+    ):
+        _listener = ChangeListener()
+    return _listener
@@ -0,0 +1,93 @@
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test image endpoints of a running server, to compare deployments. "
+        "e.g. WSGI: http://127.0.0.1:8000/api/images/, "
+        "ASGI: http://127.0.0.1:8001/api/async/images/"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("url", help="Images API url")
+        parser.add_argument(
+            "--requests", type=int, default=1000, help="Requests per endpoint"
+        )
+        parser.add_argument(
+            "--concurrency", type=int, default=100, help="Requests in flight"
+        )
+        parser.add_argument(
+            "--image", default="data/images/car.jpg", help="Image file to upload"
+        )
+
+    def handle(self, *args, **options):
+        url = options["url"].rstrip("/")
+        self.local = threading.local()
+
+        # Upload one image, retrieve and upload finished are called on it
+        response = self.session.post(
+            f"{url}/upload", json={"name": "loadtest.jpg", "mimetype": "image/jpg"}
+        )
+        response.raise_for_status()
+        image = response.json()
+        with open(options["image"], "rb") as fileobj:
+            requests.post(
+                image["presigned_post_url"]["url"],
+                data=image["presigned_post_url"]["fields"],
+                files={"file": fileobj},
+            ).raise_for_status()
+
+        endpoints = {
+            "upload": (
+                "post",
+                f"{url}/upload",
+                {"json": {"name": "loadtest.jpg", "mimetype": "image/jpg"}},
+            ),
+            "upload-finished": (
+                "patch",
+                f"{url}/{image['id']}/upload-finished/",
+                {},
+            ),
+            "retrieve": ("get", f"{url}/{image['id']}/", {}),
+        }
+        for name, (method, endpoint, kwargs) in endpoints.items():
+            self.run(name, method, endpoint, kwargs, options)
+
+    @property
+    def session(self):
+        # Keep-alive connections, one session per thread
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def request(self, method, url, kwargs):
+        start = time.perf_counter()
+        try:
+            ok = self.session.request(method, url, **kwargs).status_code < 400
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    def run(self, name, method, url, kwargs, options):
+        total = options["requests"]
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+            start = time.perf_counter()
+            results = list(
+                executor.map(lambda _: self.request(method, url, kwargs), range(total))
+            )
+            elapsed = time.perf_counter() - start
+
+        latencies = sorted(latency for latency, _ in results)
+        errors = sum(not ok for _, ok in results)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        self.stdout.write(
+            f"{name}: {total / elapsed:.1f} req/s, "
+            f"p50 {statistics.median(latencies) * 1000:.1f} ms, "
+            f"p99 {p99 * 1000:.1f} ms, {errors} errors"
+        )
@@ -0,0 +1,20 @@
+# Generated by Django 3.2.13 on 2026-10-18 07:37
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Indexes are built without locking out writes to the table
+    atomic = False
+
+    dependencies = [
+        ('images', '0003_alter_image_options'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='image',
+            index=models.Index(fields=['created_at', 'id'], name='image_created_at_id_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.13 on 2026-10-18 07:38
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Indexes are built without locking out writes to the table
+    atomic = False
+
+    dependencies = [
+        ('images', '0004_image_created_at_id_idx'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='image',
+            index=models.Index(condition=models.Q(('status__in', [1, 3, 5])), fields=['status', 'created_at'], name='image_pending_status_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='image',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['available_extensions'], name='image_extensions_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.13 on 2026-10-18 07:43
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0005_image_status_extensions_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='available_renditions',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.CharField(help_text='Rendition name like thumb, medium, large, etc', max_length=25), default=list, help_text='Store generated renditions as a Array/List', size=None),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.13 on 2026-10-18 07:54
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Indexes are built without locking out writes to the table
+    atomic = False
+
+    dependencies = [
+        ('images', '0006_image_available_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='canonical_id',
+            field=models.UUIDField(blank=True, help_text='Image with the same content, its files are shared', null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='content_hash',
+            field=models.CharField(blank=True, help_text='SHA-256 of the uploaded original', max_length=64, null=True),
+        ),
+        AddIndexConcurrently(
+            model_name='image',
+            index=django.contrib.postgres.indexes.HashIndex(fields=['content_hash'], name='image_content_hash_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='image',
+            index=models.Index(condition=models.Q(('canonical_id__isnull', False)), fields=['canonical_id'], name='image_canonical_id_idx'),
+        ),
+    ]
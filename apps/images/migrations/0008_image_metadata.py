@@ -0,0 +1,38 @@
+# Generated by Django 3.2.13 on 2026-10-18 07:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0007_image_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='format',
+            field=models.CharField(blank=True, help_text='Image format detected from the file, like JPEG, PNG', max_length=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, help_text='Height in pixels', null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='orientation',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='EXIF orientation, width and height are before rotation', null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='size',
+            field=models.PositiveBigIntegerField(blank=True, help_text='File size in bytes', null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, help_text='Width in pixels', null=True),
+        ),
+    ]
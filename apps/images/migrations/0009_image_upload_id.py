@@ -0,0 +1,18 @@
+# Generated by Django 3.2.13 on 2026-10-18 08:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0008_image_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='upload_id',
+            field=models.CharField(blank=True, help_text='Multipart upload in progress, cleared when completed or aborted', max_length=1024, null=True),
+        ),
+    ]
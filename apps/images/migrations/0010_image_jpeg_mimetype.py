@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+def fix_jpeg_mimetype(apps, schema_editor):
+    # Older uploads accepted a misspelled mimetype, without an upload size limit
+    Image = apps.get_model('images', 'Image')
+    Image.objects.filter(mimetype='.image/jpeg').update(mimetype='image/jpeg')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0009_image_upload_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(fix_jpeg_mimetype, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,29 @@
+import hashlib
+from urllib.parse import urlencode
+
+from django.conf import settings
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex, HashIndex
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
-from django.db.models import TextField, CharField, PositiveSmallIntegerField, JSONField
+from django.db.models import (
+    TextField,
+    CharField,
+    PositiveBigIntegerField,
+    PositiveIntegerField,
+    PositiveSmallIntegerField,
+    JSONField,
+    UUIDField,
+    F,
+    Index,
+    Q,
+    Value,
+)
 
+from apps.contrib.functions import ArrayAppend
 from apps.contrib.models import BaseModel
 from apps.images.choices import UploadStatus
+from apps.images.events import notify_changed
 
 
 class Image(BaseModel):
@@ -21,15 +41,149 @@ class Image(BaseModel):
         ),
         help_text=_("Store available extensions as a Array/List"),
     )
+    available_renditions = ArrayField(
+        default=list,
+        base_field=CharField(
+            max_length=25, help_text="Rendition name like thumb, medium, large, etc"
+        ),
+        help_text=_("Store generated renditions as a Array/List"),
+    )
+    format = CharField(
+        max_length=10,
+        null=True,
+        blank=True,
+        help_text=_("Image format detected from the file, like JPEG, PNG"),
+    )
+    width = PositiveIntegerField(null=True, blank=True, help_text=_("Width in pixels"))
+    height = PositiveIntegerField(
+        null=True, blank=True, help_text=_("Height in pixels")
+    )
+    size = PositiveBigIntegerField(
+        null=True, blank=True, help_text=_("File size in bytes")
+    )
+    orientation = PositiveSmallIntegerField(
+        null=True,
+        blank=True,
+        help_text=_("EXIF orientation, width and height are before rotation"),
+    )
+    content_hash = CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+        help_text=_("SHA-256 of the uploaded original"),
+    )
+    canonical_id = UUIDField(
+        null=True,
+        blank=True,
+        help_text=_("Image with the same content, its files are shared"),
+    )
+    upload_id = CharField(
+        max_length=1024,
+        null=True,
+        blank=True,
+        help_text=_("Multipart upload in progress, cleared when completed or aborted"),
+    )
     message = TextField(null=True, blank=True, help_text=_("Error messages, if any"))
 
+    @property
+    def extension(self):
+        return self.name.split(".")[-1]
+
+    @property
+    def storage_id(self):
+        """Id of the image files are stored for, duplicates share canonical files"""
+        return self.canonical_id or self.id
+
     @property
     def key(self):
-        ext = self.name.split(".")[-1]
-        return f"images/{self.id}/image-{self.id}.{ext}"
+        return self.get_key(self.extension)
+
+    def get_key(self, extension):
+        """S3 key of the image, converted images are stored next to original"""
+        return f"images/{self.storage_id}/image-{self.storage_id}.{extension}"
+
+    def get_rendition_key(self, name):
+        """S3 key of a rendition declared in IMAGE_RENDITIONS settings"""
+        extension = settings.IMAGE_RENDITIONS[name]["extension"]
+        return f"images/{self.storage_id}/{name}.{extension}"
+
+    def get_variant_key(self, extension, **params):
+        """S3 key of an on the fly resized image, derived from hash of its parameters"""
+        query = urlencode(sorted(params.items()))
+        digest = hashlib.sha256(query.encode()).hexdigest()[:32]
+        return f"images/{self.storage_id}/variants/{digest}.{extension}"
+
+    @property
+    def rendition_keys(self):
+        """S3 keys of generated renditions by name"""
+        return {
+            name: self.get_rendition_key(name)
+            for name in self.available_renditions
+            if name in settings.IMAGE_RENDITIONS
+        }
+
+    @property
+    def max_size(self):
+        """Maximum upload size in bytes, by mimetype"""
+        return settings.IMAGE_UPLOAD_MAX_SIZES[self.mimetype]
+
+    def append_value(self, field, value):
+        """
+        Append value to an array field with a single UPDATE, skipped by the database if
+        value is already there. Concurrent appends neither overwrite each other nor
+        add duplicates. Returns True if value was appended.
+        """
+        updated = (
+            Image.objects.filter(id=self.id)
+            .exclude(**{f"{field}__contains": [value]})
+            .update(
+                **{field: ArrayAppend(F(field), Value(value))},
+                updated_at=timezone.now(),
+            )
+        )
+        if value not in getattr(self, field):
+            getattr(self, field).append(value)
+        if updated:
+            notify_changed([self.id])
+        return bool(updated)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        notify_changed([self.id])
+
+    def delete(self, *args, **kwargs):
+        image_id = self.id
+        result = super().delete(*args, **kwargs)
+        notify_changed([image_id])
+        return result
 
     class Meta:
         ordering = ("-created_at",)
+        indexes = [
+            # Keyset pagination of listing
+            Index(fields=["created_at", "id"], name="image_created_at_id_idx"),
+            # Sweeps over stuck or failed uploads, settled rows are left out
+            Index(
+                fields=["status", "created_at"],
+                name="image_pending_status_idx",
+                condition=Q(
+                    status__in=[
+                        UploadStatus.UPLOADING,
+                        UploadStatus.PROCESSING,
+                        UploadStatus.ERROR,
+                    ]
+                ),
+            ),
+            # Filter by available extensions (array contains)
+            GinIndex(fields=["available_extensions"], name="image_extensions_idx"),
+            # Deduplication, equality lookups only
+            HashIndex(fields=["content_hash"], name="image_content_hash_idx"),
+            Index(
+                fields=["canonical_id"],
+                name="image_canonical_id_idx",
+                condition=Q(canonical_id__isnull=False),
+            ),
+        ]
         verbose_name = _("Image")
         verbose_name_plural = _("Images")
 
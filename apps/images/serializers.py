@@ -1,14 +1,50 @@
+from django.conf import settings
+from django.db.models import Manager
 from django.utils.translation import ugettext_lazy as _
 
 from drf_spectacular.utils import extend_schema_field
 from rest_framework.exceptions import ValidationError
-from rest_framework.fields import SerializerMethodField, CharField, ListField
-from rest_framework.serializers import ModelSerializer, Serializer
+from rest_framework.fields import (
+    SerializerMethodField,
+    CharField,
+    ChoiceField,
+    DateTimeField,
+    DictField,
+    IntegerField,
+    ListField,
+    UUIDField,
+)
+from rest_framework.serializers import ListSerializer, ModelSerializer, Serializer
 
 from apps.contrib.serializers import PresignedPostURLSerializer
-from apps.contrib.storage import generate_presigned_post, generate_presigned_url
+from apps.contrib.storage import (
+    create_multipart_upload,
+    generate_presigned_post,
+    generate_presigned_url,
+    generate_presigned_urls,
+)
+from apps.images.choices import UploadStatus
+from apps.images.conversion import FORMATS, MIMETYPE_FORMATS
 from apps.images.models import Image
 
+# Maximum parts of a S3 multipart upload
+MULTIPART_MAX_PARTS = 10000
+
+
+class ImageListSerializer(ListSerializer):
+    """Sign pre-signed urls of all images in one pass, instead of one by one"""
+
+    def to_representation(self, data):
+        images = list(data.all() if isinstance(data, Manager) else data)
+        self._context["presigned_urls"] = generate_presigned_urls(
+            [
+                key
+                for image in images
+                for key in (image.key, *image.rendition_keys.values())
+            ]
+        )
+        return super().to_representation(images)
+
 
 class ImageSerializer(ModelSerializer):
     status = SerializerMethodField(read_only=True, help_text=_("Display status value"))
@@ -18,6 +54,10 @@ class ImageSerializer(ModelSerializer):
     presigned_url = SerializerMethodField(
         read_only=True, help_text=_("AWS S3 pre-signed image url")
     )
+    renditions = SerializerMethodField(
+        read_only=True,
+        help_text=_("AWS S3 pre-signed urls of generated renditions by name"),
+    )
 
     class Meta:
         model = Image
@@ -28,15 +68,32 @@ class ImageSerializer(ModelSerializer):
             "available_extensions",
             "status",
             "presigned_url",
+            "renditions",
+            "format",
+            "width",
+            "height",
+            "size",
+            "orientation",
             "message",
         )
+        read_only_fields = ("format", "width", "height", "size", "orientation")
+        list_serializer_class = ImageListSerializer
 
     def get_status(self, obj):
-        return obj.get_status_display()
+        return UploadStatus(obj.status).label
 
     @extend_schema_field(CharField)
     def get_presigned_url(self, obj):
-        return generate_presigned_url(obj.key)
+        presigned_urls = self.context.get("presigned_urls", {})
+        return presigned_urls.get(obj.key) or generate_presigned_url(obj.key)
+
+    @extend_schema_field(DictField(child=CharField()))
+    def get_renditions(self, obj):
+        presigned_urls = self.context.get("presigned_urls", {})
+        return {
+            name: presigned_urls.get(key) or generate_presigned_url(key)
+            for name, key in obj.rendition_keys.items()
+        }
 
     @staticmethod
     def validate_name(name):
@@ -50,11 +107,9 @@ class ImageSerializer(ModelSerializer):
     @staticmethod
     def validate_mimetype(mimetype):
         if mimetype:
-            if mimetype not in ("image/jpg", ".image/jpeg", "image/png"):
+            if mimetype not in MIMETYPE_FORMATS:
                 raise ValidationError(
-                    {
-                        "error": "Not a valid mimetype (image/jpg, .image/jpeg, image/png)"
-                    }
+                    {"error": "Not a valid mimetype (image/jpg, image/jpeg, image/png)"}
                 )
         return mimetype
 
@@ -83,19 +138,21 @@ class ImageUploadSerializer(ModelSerializer):
             "presigned_url",
             "message",
         )
+        list_serializer_class = ImageListSerializer
 
     def get_status(self, obj):
-        return obj.get_status_display()
+        return UploadStatus(obj.status).label
 
     @extend_schema_field(PresignedPostURLSerializer)
     def get_presigned_post_url(self, obj):
         return PresignedPostURLSerializer(
-            generate_presigned_post(obj.key), many=False
+            generate_presigned_post(obj.key, obj.mimetype, obj.max_size), many=False
         ).data
 
     @extend_schema_field(CharField)
     def get_presigned_url(self, obj):
-        return generate_presigned_url(obj.key)
+        presigned_urls = self.context.get("presigned_urls", {})
+        return presigned_urls.get(obj.key) or generate_presigned_url(obj.key)
 
     @staticmethod
     def validate_name(name):
@@ -109,14 +166,130 @@ class ImageUploadSerializer(ModelSerializer):
     @staticmethod
     def validate_mimetype(mimetype):
         if mimetype:
-            if mimetype not in ("image/jpg", ".image/jpeg", "image/png"):
+            if mimetype not in MIMETYPE_FORMATS:
                 raise ValidationError(
-                    {
-                        "error": "Not a valid mimetype (image/jpg, .image/jpeg, image/png)"
-                    }
+                    {"error": "Not a valid mimetype (image/jpg, image/jpeg, image/png)"}
                 )
         return mimetype
 
+    def validate(self, attrs):
+        extension = attrs["name"].split(".")[-1]
+        if FORMATS[extension.lower()] != MIMETYPE_FORMATS[attrs["mimetype"]]:
+            raise ValidationError({"error": "Mimetype doesn't match the file name"})
+        # Original extension is available from the start, saved with the insert
+        attrs["available_extensions"] = [extension]
+        return attrs
+
+
+class ImageMultipartUploadSerializer(ImageUploadSerializer):
+    # Parts are uploaded with part urls, instead of a pre-signed post
+    presigned_post_url = None
+    presigned_url = None
+    size = IntegerField(min_value=1, help_text=_("File size in bytes"))
+    part_size = SerializerMethodField(
+        read_only=True, help_text=_("Bytes in each part, except the last part")
+    )
+    parts_count = SerializerMethodField(
+        read_only=True, help_text=_("Number of parts to upload")
+    )
+
+    class Meta:
+        model = Image
+        fields = (
+            "id",
+            "name",
+            "mimetype",
+            "available_extensions",
+            "status",
+            "size",
+            "part_size",
+            "parts_count",
+            "message",
+        )
+
+    @extend_schema_field(IntegerField)
+    def get_part_size(self, obj):
+        # Parts grow for large files, S3 allows up to 10000 parts
+        return max(
+            settings.IMAGE_MULTIPART_PART_SIZE, -(-obj.size // MULTIPART_MAX_PARTS)
+        )
+
+    @extend_schema_field(IntegerField)
+    def get_parts_count(self, obj):
+        return -(-obj.size // self.get_part_size(obj))
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        max_size = settings.IMAGE_UPLOAD_MAX_SIZES[attrs["mimetype"]]
+        if attrs["size"] > max_size:
+            raise ValidationError({"error": f"Maximum file size is {max_size} bytes"})
+        return attrs
+
+    def create(self, validated_data):
+        image = Image(**validated_data)
+        image.upload_id = create_multipart_upload(image.key, image.mimetype)
+        image.save()
+        return image
+
+
+class ImageMultipartPartSerializer(Serializer):
+    part_number = IntegerField(help_text=_("Part number, from 1"))
+    etag = CharField(help_text=_("Entity tag of the uploaded part"))
+    size = IntegerField(help_text=_("Part size in bytes"))
+
+
+class ImageMultipartPartsInputSerializer(Serializer):
+    part_numbers = ListField(
+        child=IntegerField(min_value=1, max_value=MULTIPART_MAX_PARTS),
+        allow_empty=False,
+        help_text=_("Part numbers to sign upload urls for"),
+    )
+
+    @staticmethod
+    def validate_part_numbers(part_numbers):
+        max_size = settings.IMAGE_MULTIPART_MAX_PARTS_PER_REQUEST
+        if len(part_numbers) > max_size:
+            raise ValidationError(
+                {"error": f"Maximum {max_size} parts can be signed at once"}
+            )
+        return part_numbers
+
+
+class ImageMultipartPartsSerializer(Serializer):
+    urls = DictField(
+        child=CharField(), help_text=_("Pre-signed PUT urls by part number")
+    )
+
+
+class ImageBulkUploadSerializer(Serializer):
+    images = ImageUploadSerializer(
+        many=True, allow_empty=False, help_text=_("Images to upload")
+    )
+
+    @staticmethod
+    def validate_images(images):
+        max_size = settings.IMAGE_BULK_UPLOAD_MAX_SIZE
+        if len(images) > max_size:
+            raise ValidationError(
+                {"error": f"Maximum {max_size} images can be uploaded at once"}
+            )
+        return images
+
+
+class ImageBulkDeleteSerializer(Serializer):
+    ids = ListField(
+        child=UUIDField(), allow_empty=False, help_text=_("Ids of images to delete")
+    )
+
+    @staticmethod
+    def validate_ids(ids):
+        max_size = settings.IMAGE_BULK_DELETE_MAX_SIZE
+        if len(ids) > max_size:
+            raise ValidationError(
+                {"error": f"Maximum {max_size} images can be deleted at once"}
+            )
+        return ids
+
 
 class ImageUploadFinishedInputSerializer(Serializer):
     pass
@@ -138,3 +311,68 @@ class ImageRetrieveQuerySerializer(Serializer):
                     {"error": "Not a valid image extension requested (png, jpg, jpeg)"}
                 )
         return extension
+
+
+class ImageResizeQuerySerializer(ImageRetrieveQuerySerializer):
+    width = IntegerField(min_value=1, help_text=_("Width of resized image"))
+    height = IntegerField(min_value=1, help_text=_("Height of resized image"))
+    fit = ChoiceField(
+        default="contain",
+        choices=[
+            ("contain", _("Fit whole image inside the box")),
+            ("cover", _("Fill the box, cropped at center")),
+        ],
+        help_text=_("How image is fitted into width x height box"),
+    )
+    quality = IntegerField(
+        required=False,
+        min_value=1,
+        max_value=100,
+        help_text=_("JPEG encoder quality"),
+    )
+
+    def validate(self, attrs):
+        max_size = settings.IMAGE_RESIZE_MAX_SIZE
+        if attrs["width"] > max_size or attrs["height"] > max_size:
+            raise ValidationError({"error": f"Maximum width and height is {max_size}"})
+        return attrs
+
+
+class UploadStatusField(ChoiceField):
+    """Upload status in query params by lowercase name, like `uploading`"""
+
+    def __init__(self, **kwargs):
+        choices = [(choice.name.lower(), choice.label) for choice in UploadStatus]
+        super().__init__(choices, **kwargs)
+
+    def to_internal_value(self, data):
+        return UploadStatus[super().to_internal_value(data).upper()]
+
+
+class ImageWaitQuerySerializer(Serializer):
+    status = UploadStatusField(
+        required=False,
+        help_text=_("Last known status, responds when image status is different"),
+    )
+    timeout = IntegerField(
+        default=30,
+        min_value=1,
+        help_text=_("Seconds to wait, responds with current status when passed"),
+    )
+
+    @staticmethod
+    def validate_timeout(timeout):
+        return min(timeout, settings.IMAGE_WAIT_MAX_TIMEOUT)
+
+
+class ImageListQuerySerializer(Serializer):
+    status = UploadStatusField(required=False, help_text=_("Filter by upload status"))
+    extension = CharField(
+        required=False, help_text=_("Filter by available image extension")
+    )
+    created_after = DateTimeField(
+        required=False, help_text=_("Filter images created at or after this time")
+    )
+    created_before = DateTimeField(
+        required=False, help_text=_("Filter images created before this time")
+    )
@@ -1,24 +1,511 @@
+import hashlib
+import re
+from datetime import timedelta
+from io import BytesIO
+from itertools import chain
+
 from celery import shared_task
+from celery.exceptions import SoftTimeLimitExceeded
 from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from PIL import ImageOps
 
-from apps.contrib.storage import check_file_exists
+from apps.contrib.cache import single_flight
+from apps.contrib.storage import (
+    abort_multipart_upload,
+    check_file_exists,
+    delete_objects,
+    download_fileobj,
+    exists_cache,
+    get_file_size,
+    list_keys,
+    read_header,
+    spooled_fileobj,
+    upload_fileobj,
+)
 from apps.images.choices import UploadStatus
+from apps.images.conversion import (
+    FORMATS,
+    ImageTooLarge,
+    convert,
+    encode,
+    open_image,
+    read_metadata,
+    resize,
+)
+from apps.images.events import notify_changed
 from apps.images.models import Image
 
 logger = get_task_logger(__name__)
 
+# Status message of uploads over IMAGE_UPLOAD_MAX_SIZES, these are deleted unread
+TOO_LARGE_MESSAGE = "File too large"
+
+# Decoding tasks run under time limits, memory is bounded by IMAGE_MAX_PIXELS
+DECODING_LIMITS = {
+    "soft_time_limit": settings.IMAGE_TASK_SOFT_TIME_LIMIT,
+    "time_limit": settings.IMAGE_TASK_TIME_LIMIT,
+}
+
+# Images failing with these can't be decoded within the limits, retries fail again
+LIMIT_ERRORS = (ImageTooLarge, MemoryError, SoftTimeLimitExceeded)
+
+# images/{id}/image-{id}.{extension}
+IMAGE_KEY_PATTERN = re.compile(r"^images/([0-9a-f-]{36})/image-\1\.[^/]+$")
+
+
+def _set_message(image_id, message):
+    Image.objects.filter(id=image_id).update(message=message, updated_at=timezone.now())
+    notify_changed([image_id])
+
+
+def _set_error(image_id, error):
+    """Set image to error, for decoding over the limits"""
+    if isinstance(error, MemoryError):
+        message = "Out of memory while decoding"
+    elif isinstance(error, SoftTimeLimitExceeded):
+        message = "Time limit exceeded while decoding"
+    else:
+        message = str(error)
+    Image.objects.filter(id=image_id).update(
+        status=UploadStatus.ERROR, message=message, updated_at=timezone.now()
+    )
+    notify_changed([image_id])
+
+
+def queue_uploaded_images(image_ids):
+    """Run post upload stages of uploaded images in background"""
+    for image_id in image_ids:
+        process_uploaded_image.s(image_id).apply_async()
+
+
+def mark_images_uploaded(keys):
+    """
+    Set status of uploading images to uploaded, by the S3 keys of their originals.
+    Returns ids of updated images
+    """
+    keys = set(keys)
+    image_ids = {
+        match.group(1) for match in map(IMAGE_KEY_PATTERN.match, keys) if match
+    }
+    uploaded = [
+        image.id
+        for image in Image.objects.filter(
+            id__in=image_ids, status=UploadStatus.UPLOADING
+        ).only("id", "name", "canonical_id")
+        if image.key in keys
+    ]
+    if uploaded:
+        Image.objects.filter(id__in=uploaded).update(
+            status=UploadStatus.UPLOADED, updated_at=timezone.now()
+        )
+        notify_changed(uploaded)
+    for key in keys:
+        exists_cache.set(key, True, settings.AWS_EXISTS_CACHE_TIMEOUT)
+    queue_uploaded_images(uploaded)
+    return uploaded
+
+
+@shared_task(name="apps.images.sweep_image_uploads")
+def sweep_image_uploads():
+    """
+    Verify images stuck in uploading for IMAGE_UPLOAD_SWEEP_AGE seconds, scheduled
+    by celery beat. Existing keys are found by listing the bucket in pages of
+    1000 keys instead of one request per image, up to IMAGE_UPLOAD_SWEEP_MAX_PAGES
+    pages, keys not reached by then are checked one by one. Statuses are set with
+    one update per status for the batch.
+    """
+    with single_flight("sweep-image-uploads") as acquired:
+        if not acquired:
+            # Previous sweep is still running
+            return
+        now = timezone.now()
+        created_before = now - timedelta(seconds=settings.IMAGE_UPLOAD_SWEEP_AGE)
+        # Multipart uploads are given longer to finish
+        multipart_before = now - timedelta(seconds=settings.IMAGE_MULTIPART_SWEEP_AGE)
+        images = {
+            image.key: image
+            for image in Image.objects.filter(
+                Q(upload_id__isnull=True) | Q(created_at__lt=multipart_before),
+                status=UploadStatus.UPLOADING,
+                created_at__lt=created_before,
+            )
+            .order_by("created_at")
+            .only("id", "name", "canonical_id", "upload_id")[
+                : settings.IMAGE_UPLOAD_SWEEP_BATCH_SIZE
+            ]
+        }
+        pending = {key: image.id for key, image in images.items()}
+        if not pending:
+            return
+
+        found = set()
+        listed = True
+        for page, keys in enumerate(list_keys("images/"), 1):
+            found.update(key for key in keys if key in pending)
+            if len(found) == len(pending):
+                break
+            if page >= settings.IMAGE_UPLOAD_SWEEP_MAX_PAGES:
+                listed = False
+                break
+        not_found = pending.keys() - found
+        if not listed:
+            # Bucket is larger than the listing budget, check the rest directly
+            for key in list(not_found):
+                try:
+                    exists = get_file_size(key) is not None
+                except Exception as e:
+                    # Left uploading, checked again by the next sweep
+                    logger.error("Upload Error: %s (%s)", e, pending[key])
+                    not_found.discard(key)
+                    continue
+                if exists:
+                    found.add(key)
+                    not_found.discard(key)
+        uploaded = [pending[key] for key in found]
+        # Pre-signed posts are expired by now, missing files will never be uploaded
+        missing = [pending[key] for key in not_found]
+
+        # Unfinished multipart uploads keep their parts in the bucket until aborted
+        for key in not_found:
+            if images[key].upload_id:
+                try:
+                    abort_multipart_upload(key, images[key].upload_id)
+                except Exception as e:
+                    logger.error("Upload Abort Error: %s (%s)", e, images[key].id)
+
+        now = timezone.now()
+        Image.objects.filter(id__in=uploaded, status=UploadStatus.UPLOADING).update(
+            status=UploadStatus.UPLOADED, upload_id=None, updated_at=now
+        )
+        Image.objects.filter(id__in=missing, status=UploadStatus.UPLOADING).update(
+            status=UploadStatus.ERROR,
+            message="Not Uploaded",
+            upload_id=None,
+            updated_at=now,
+        )
+        notify_changed(uploaded + missing)
+        queue_uploaded_images(uploaded)
+        logger.info(
+            "Upload sweep: %s uploaded, %s missing", len(uploaded), len(missing)
+        )
+
 
 @shared_task(max_retries=3, name="apps.images.process_image_upload")
 def process_image_upload(image_id):
+    """Verify upload of one image, uploads are swept by sweep_image_uploads"""
     image = Image.objects.get(id=image_id)
+    if image.status != UploadStatus.UPLOADING:
+        # Already verified, e.g. by S3 upload event
+        return
     try:
-        if check_file_exists(image.key):
-            image.status = UploadStatus.UPLOADED
-        else:
+        image.size = get_file_size(image.key)
+        if image.size is None:
             image.status = UploadStatus.ERROR
             image.message = "Not Uploaded"
+        elif image.size > image.max_size:
+            image.status = UploadStatus.ERROR
+            image.message = TOO_LARGE_MESSAGE
+            delete_objects([image.key])
+        else:
+            image.status = UploadStatus.UPLOADED
     except Exception as e:
         image.status = UploadStatus.ERROR
         image.message = str(e)
         logger.error("Upload Error", e, image_id)
-    image.save()
+    image.save(update_fields=["status", "message", "size", "updated_at"])
+    if image.status == UploadStatus.UPLOADED:
+        queue_uploaded_images([image.id])
+
+
+@shared_task(
+    max_retries=3, name="apps.images.process_uploaded_image", **DECODING_LIMITS
+)
+def process_uploaded_image(image_id):
+    """Post upload stages of an image, metadata, deduplication and renditions"""
+    if not extract_metadata(image_id):
+        return
+    if settings.IMAGE_DEDUPLICATION:
+        deduplicate_image(image_id)
+    if settings.IMAGE_RENDITIONS:
+        generate_renditions(image_id)
+
+
+@shared_task(max_retries=3, name="apps.images.extract_metadata")
+def extract_metadata(image_id):
+    """
+    Record real format, dimensions, byte size and EXIF orientation of the uploaded
+    original. Only the header is read with a ranged GET, unless it is bigger than
+    IMAGE_HEADER_SIZE (e.g. large EXIF). Files which aren't valid images are set
+    to error. Returns True if image is valid.
+    """
+    image = Image.objects.get(id=image_id)
+    if image.format:
+        return True
+    try:
+        header, image.size = read_header(image.key, settings.IMAGE_HEADER_SIZE)
+        if image.size > image.max_size:
+            # Never decoded, however the object got past the upload policy
+            image.status = UploadStatus.ERROR
+            image.message = TOO_LARGE_MESSAGE
+            image.save(update_fields=["status", "message", "size", "updated_at"])
+            if not image.canonical_id:
+                delete_objects([image.key])
+            return False
+        try:
+            metadata = read_metadata(BytesIO(header))
+        except OSError:
+            if len(header) >= image.size:
+                raise
+            with download_fileobj(image.key) as fileobj:
+                metadata = read_metadata(fileobj)
+        if metadata["format"] not in FORMATS.values():
+            raise OSError(f"Not a supported image format ({metadata['format']})")
+    except ImageTooLarge as e:
+        # Decompression bomb, later stages would decode it
+        image.status = UploadStatus.ERROR
+        image.message = str(e)
+        image.save(update_fields=["status", "message", "size", "updated_at"])
+        return False
+    except OSError as e:
+        image.status = UploadStatus.ERROR
+        image.message = f"Not a valid image: {e}"
+        image.save(update_fields=["status", "message", "size", "updated_at"])
+        return False
+    except Exception as e:
+        _set_message(image_id, str(e))
+        logger.error("Image Metadata Error: %s (%s)", e, image_id)
+        return True
+
+    for field, value in metadata.items():
+        setattr(image, field, value)
+    image.save(update_fields=[*metadata, "size", "updated_at"])
+    return True
+
+
+@shared_task(max_retries=3, name="apps.images.deduplicate_image")
+def deduplicate_image(image_id):
+    """
+    Hash content of the uploaded original. If an earlier image has the same content,
+    image becomes its duplicate: canonical files and derivatives are shared and the
+    uploaded copy is deleted, so storage and conversions scale with unique content.
+    """
+    image = Image.objects.get(id=image_id)
+    if image.content_hash or image.status != UploadStatus.UPLOADED:
+        return
+    try:
+        digest = hashlib.sha256()
+        with download_fileobj(image.key) as fileobj:
+            for chunk in iter(
+                lambda: fileobj.read(settings.AWS_TRANSFER_CHUNK_SIZE), b""
+            ):
+                digest.update(chunk)
+    except Exception as e:
+        _set_message(image_id, str(e))
+        logger.error("Image Hash Error: %s (%s)", e, image_id)
+        return
+
+    image.content_hash = digest.hexdigest()
+    canonical = (
+        Image.objects.filter(
+            content_hash=image.content_hash,
+            canonical_id__isnull=True,
+            created_at__lt=image.created_at,
+        )
+        .order_by("created_at")
+        .first()
+    )
+    # Converted files are named by extension, originals must have the same one
+    if canonical is None or canonical.extension != image.extension:
+        image.save(update_fields=["content_hash", "updated_at"])
+        return
+
+    image.canonical_id = canonical.id
+    # Own conversions are deleted with the upload, only canonical files remain
+    image.available_extensions = canonical.available_extensions
+    image.available_renditions = canonical.available_renditions
+    image.save(
+        update_fields=[
+            "content_hash",
+            "canonical_id",
+            "available_extensions",
+            "available_renditions",
+            "updated_at",
+        ]
+    )
+    delete_objects(chain.from_iterable(list_keys(f"images/{image.id}/")))
+
+
+@shared_task(max_retries=3, name="apps.images.convert_image", **DECODING_LIMITS)
+def convert_image(image_id, extension):
+    """
+    Convert original image to the given extension and store it next to original,
+    concurrent tasks for the same conversion convert it only once.
+    """
+    image = Image.objects.get(id=image_id)
+    key = image.get_key(extension)
+    with single_flight(key) as acquired:
+        if not acquired:
+            # Another task is converting it
+            return
+        try:
+            # Converted file can already exist, if same conversion was queued twice
+            if not check_file_exists(key):
+                with download_fileobj(
+                    image.key
+                ) as fileobj, spooled_fileobj() as output:
+                    upload_fileobj(key, convert(fileobj, extension, output=output))
+        except LIMIT_ERRORS as e:
+            _set_error(image_id, e)
+            logger.error("Image Conversion Error: %s (%s)", e, image_id)
+        except Exception as e:
+            _set_message(image_id, str(e))
+            logger.error("Image Conversion Error: %s (%s)", e, image_id)
+        else:
+            # Update available extensions
+            image.append_value("available_extensions", extension)
+
+
+@shared_task(max_retries=3, name="apps.images.generate_renditions", **DECODING_LIMITS)
+def generate_renditions(image_id):
+    """
+    Generate renditions declared in IMAGE_RENDITIONS settings, original image is
+    downloaded and decoded once for all of them. Already generated ones are skipped,
+    originals already fitting a rendition of the same format are stored as is.
+    """
+    image = Image.objects.get(id=image_id)
+    renditions = {
+        name: spec
+        for name, spec in settings.IMAGE_RENDITIONS.items()
+        if name not in image.available_renditions
+    }
+    if not renditions:
+        return
+    with single_flight(f"renditions:{image.storage_id}") as acquired:
+        if not acquired:
+            # Another task is generating them
+            return
+        # Duplicates share renditions generated for the canonical image
+        for name in list(renditions):
+            if check_file_exists(image.get_rendition_key(name)):
+                image.append_value("available_renditions", name)
+                del renditions[name]
+        if not renditions:
+            return
+        # Originals already fitting are stored as is, without decoding
+        copies = {name: spec for name, spec in renditions.items() if _fits(image, spec)}
+        try:
+            with download_fileobj(image.key) as fileobj:
+                for name in copies:
+                    fileobj.seek(0)
+                    upload_fileobj(image.get_rendition_key(name), fileobj)
+                    image.append_value("available_renditions", name)
+                    del renditions[name]
+                if renditions:
+                    fileobj.seek(0)
+                    _encode_renditions(image, fileobj, renditions)
+        except LIMIT_ERRORS as e:
+            _set_error(image_id, e)
+            logger.error("Rendition Error: %s (%s)", e, image_id)
+        except Exception as e:
+            _set_message(image_id, str(e))
+            logger.error("Rendition Error: %s (%s)", e, image_id)
+
+
+def _fits(image, spec):
+    """Original fits inside the rendition box, with the same format and rotation"""
+    return (
+        image.width is not None
+        and image.width <= spec["width"]
+        and image.height <= spec["height"]
+        and spec.get("fit", "contain") == "contain"
+        and image.format == FORMATS[spec["extension"]]
+        and image.orientation in (None, 1)
+    )
+
+
+def _encode_renditions(image, fileobj, renditions):
+    # Decoded once, at a scale covering the largest rendition
+    size = (
+        max(spec["width"] for spec in renditions.values()),
+        max(spec["height"] for spec in renditions.values()),
+    )
+    with open_image(fileobj, size) as original:
+        original = ImageOps.exif_transpose(original)
+        for name, spec in renditions.items():
+            rendition = resize(
+                original, spec["width"], spec["height"], spec.get("fit", "contain")
+            )
+            with spooled_fileobj() as output:
+                upload_fileobj(
+                    image.get_rendition_key(name),
+                    encode(rendition, spec["extension"], output=output),
+                )
+            image.append_value("available_renditions", name)
+
+
+@shared_task(max_retries=3, name="apps.images.resize_image", **DECODING_LIMITS)
+def resize_image(image_id, width, height, fit="contain", quality=None, extension=None):
+    """
+    Resize original image and store it under a key derived from the parameters,
+    concurrent tasks for the same variant encode it only once.
+    """
+    image = Image.objects.get(id=image_id)
+    extension = extension or image.extension
+    options = {"quality": quality} if quality else {}
+    key = image.get_variant_key(
+        extension, width=width, height=height, fit=fit, **options
+    )
+    with single_flight(key) as acquired:
+        # Another task is encoding it or it is already stored
+        if not acquired or check_file_exists(key):
+            return
+        try:
+            with download_fileobj(image.key) as fileobj, open_image(
+                fileobj, (width, height)
+            ) as original, spooled_fileobj() as output:
+                variant = resize(ImageOps.exif_transpose(original), width, height, fit)
+                upload_fileobj(
+                    key, encode(variant, extension, output=output, **options)
+                )
+        except LIMIT_ERRORS as e:
+            _set_error(image_id, e)
+            logger.error("Image Resize Error: %s (%s)", e, image_id)
+        except Exception as e:
+            _set_message(image_id, str(e))
+            logger.error("Image Resize Error: %s (%s)", e, image_id)
+
+
+@shared_task(max_retries=3, name="apps.images.delete_image_objects")
+def delete_image_objects(storage_ids, uploads=()):
+    """
+    Delete every object of deleted images by their storage ids, original and
+    derivatives under images/{id}/, with up to 1000 keys per DeleteObjects request.
+    Files still shared with remaining images (duplicates) are kept.
+    Unfinished multipart uploads, as (key, upload id) pairs, are aborted.
+    """
+    # Uploaded parts are not listed as objects, only aborting deletes them
+    for key, upload_id in uploads:
+        try:
+            abort_multipart_upload(key, upload_id)
+        except Exception as e:
+            logger.error("Upload Abort Error: %s (%s)", e, key)
+
+    storage_ids = {str(storage_id) for storage_id in storage_ids}
+    referenced = {
+        str(value)
+        for value in chain.from_iterable(
+            Image.objects.filter(
+                Q(id__in=storage_ids) | Q(canonical_id__in=storage_ids)
+            ).values_list("id", "canonical_id")
+        )
+    }
+    pages = chain.from_iterable(
+        list_keys(f"images/{storage_id}/")
+        for storage_id in sorted(storage_ids - referenced)
+    )
+    failed = delete_objects(chain.from_iterable(pages))
+    if failed:
+        logger.error("Image Delete Error: %s keys not deleted", len(failed))
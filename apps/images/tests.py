@@ -1,18 +1,56 @@
+import base64
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from unittest import mock
+from urllib.parse import quote_plus, urlencode
+from uuid import uuid4
+
 import boto3
+from celery.exceptions import SoftTimeLimitExceeded
+from botocore.config import Config
 import requests
 
 from moto import mock_s3
+from PIL import Image as PILImage
 
 from django.conf import settings
+from django.core.cache import cache
+from django.test import override_settings
+from django.utils import timezone
 from rest_framework import status
 
 from rest_framework.test import APITestCase, APIClient
 
 from apps.contrib import storage
+from apps.contrib.cache import clear_local_caches, single_flight
 from apps.contrib.storage import (
     generate_presigned_post,
     check_file_exists,
+    delete_objects,
+    download_fileobj,
     generate_presigned_url,
+    generate_presigned_urls,
+    list_keys,
+    upload_fileobj,
+)
+from apps.images.choices import UploadStatus
+from apps.images.conversion import convert, open_image, read_metadata, resize
+from apps.images.events import notify_changed
+from apps.images.models import Image
+from apps.images.tasks import (
+    convert_image,
+    deduplicate_image,
+    delete_image_objects,
+    extract_metadata,
+    generate_renditions,
+    process_image_upload,
+    resize_image,
+    sweep_image_uploads,
 )
 
 # Override AWS setting (Please don't change this, this might delete s3 data)
@@ -23,8 +61,13 @@ settings.AWS_SESSION_TOKEN = "testing"
 settings.AWS_BUCKET_REGION = "us-east-1"
 settings.AWS_BUCKET_NAME = "bucket"
 settings.AWS_S3_ENDPOINT_URL = "http://127.0.0.1:5000"
+# Files are uploaded directly with pre-signed posts, don't cache missing keys
+settings.AWS_EXISTS_NEGATIVE_CACHE_TIMEOUT = 0
 
 
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
 class ImageTestCase(APITestCase):
     # Init moto
     mock_s3 = mock_s3()
@@ -32,12 +75,21 @@ class ImageTestCase(APITestCase):
     def setUp(self):
         self.mock_s3.start()
 
+        # Clear cache
+        cache.clear()
+        clear_local_caches()
+
         # Init Client
         self.client = APIClient()
 
-        # Init boto3 s3 client
+        # Init boto3 s3 client, signing same as storage s3 client
         self.s3 = boto3.client(
-            "s3", endpoint_url="http://127.0.0.1:5000", region_name="us-east-1"
+            "s3",
+            endpoint_url="http://127.0.0.1:5000",
+            region_name="us-east-1",
+            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+            config=Config(signature_version="s3v4"),
         )
 
         # Override storage s3
@@ -121,6 +173,119 @@ class ImageTestCase(APITestCase):
         res = requests.request("GET", file_url)
         self.assertEqual(res.status_code, status.HTTP_200_OK)
 
+    def test_check_file_exists(self):
+        """
+        Test check_file_exists method, checks exact key and caches the result
+        """
+        key = "test/car.jpg"
+        self.s3.put_object(Bucket=settings.AWS_BUCKET_NAME, Key="test/car.jpg.bak")
+        self.assertEqual(check_file_exists(key), False)
+
+        self.s3.put_object(Bucket=settings.AWS_BUCKET_NAME, Key=key)
+        self.assertEqual(check_file_exists("test/car.jp"), False)
+        self.assertEqual(check_file_exists(key), True)
+
+        # Found key is served from cache
+        self.s3.delete_object(Bucket=settings.AWS_BUCKET_NAME, Key=key)
+        self.assertEqual(check_file_exists(key), True)
+        storage.exists_cache.local.clear()
+        self.assertEqual(check_file_exists(key), True)
+
+        # Missing key is cached and updated on upload
+        with self.settings(AWS_EXISTS_NEGATIVE_CACHE_TIMEOUT=60):
+            key = "test/flower.png"
+            self.assertEqual(check_file_exists(key), False)
+            self.s3.put_object(Bucket=settings.AWS_BUCKET_NAME, Key=key)
+            self.assertEqual(check_file_exists(key), False)
+
+            with open("data/images/flower.png", "rb") as fileobj:
+                upload_fileobj(key, fileobj)
+            self.assertEqual(check_file_exists(key), True)
+
+    def test_storage_client(self):
+        """
+        Test storage client config, a client per forked process and object delete
+        """
+        client = storage.create_client()
+        self.assertEqual(
+            client.meta.config.max_pool_connections, settings.AWS_MAX_POOL_CONNECTIONS
+        )
+        self.assertEqual(client.meta.config.retries["mode"], settings.AWS_RETRY_MODE)
+
+        # Forked process builds its own client
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if storage.s3 is not self.s3 else 1)
+        _, exit_status = os.waitpid(pid, 0)
+        self.assertEqual(exit_status, 0)
+        self.assertIs(storage.s3, self.s3)
+
+        key = "test/car.jpg"
+        with open("data/images/car.jpg", "rb") as fileobj:
+            upload_fileobj(key, fileobj)
+        self.assertTrue(check_file_exists(key))
+        self.assertEqual(delete_objects([key]), [])
+        self.assertFalse(check_file_exists(key))
+
+    def test_download_fileobj(self):
+        """
+        Test download_fileobj method, that streams object into a spooled temporary file
+        """
+        key = "test/car.jpg"
+        with open("data/images/car.jpg", "rb") as fileobj:
+            content = fileobj.read()
+        self.s3.put_object(Bucket=settings.AWS_BUCKET_NAME, Key=key, Body=content)
+
+        with download_fileobj(key) as fileobj:
+            self.assertIsInstance(fileobj, SpooledTemporaryFile)
+            self.assertEqual(fileobj.read(), content)
+        self.assertTrue(fileobj.closed)
+
+    def test_presigned_url_cache(self):
+        """
+        Test presigned_url method reuses signed url for a part of its lifetime
+        """
+        key = "test/flower.png"
+        with mock.patch.object(
+            self.s3, "generate_presigned_url", wraps=self.s3.generate_presigned_url
+        ) as sign:
+            file_url = generate_presigned_url(key)
+            self.assertEqual(generate_presigned_url(key), file_url)
+            self.assertEqual(sign.call_count, 1)
+
+            # Cache is local and shared, other processes reuse the url as well
+            clear_local_caches()
+            self.assertEqual(generate_presigned_url(key), file_url)
+            self.assertEqual(sign.call_count, 1)
+
+            with self.settings(AWS_PRESIGNED_URL_REUSE=0):
+                generate_presigned_url("test/car.jpg")
+                generate_presigned_url("test/car.jpg")
+                self.assertEqual(sign.call_count, 3)
+
+    def test_presigned_urls(self):
+        """
+        Test presigned_urls method, bulk signed urls are same as boto3 signed urls
+        """
+        keys = ["test/car.jpg", "test/flower.png", "test/a+b~c.png"]
+        now = datetime(2022, 6, 15, 10, 30)
+        with mock.patch(
+            "apps.contrib.storage.datetime"
+        ) as storage_datetime, mock.patch(
+            "botocore.auth.datetime"
+        ) as botocore_datetime:
+            storage_datetime.utcnow.return_value = now
+            botocore_datetime.datetime.utcnow.return_value = now
+            urls = generate_presigned_urls(keys)
+
+            for key in keys:
+                file_url = self.s3.generate_presigned_url(
+                    "get_object",
+                    Params={"Bucket": settings.AWS_BUCKET_NAME, "Key": key},
+                    ExpiresIn=settings.AWS_EXPIRY,
+                )
+                self.assertEqual(urls[key], file_url)
+
     def test_image_upload_with_wrong_format(self):
         """
         Test image upload with wrong format. Only accepts (.png, .jpg, .jpeg)
@@ -153,6 +318,12 @@ class ImageTestCase(APITestCase):
         )
         self.assertEqual(request.status_code, status.HTTP_400_BAD_REQUEST)
 
+        file_name = "sample.jpeg"
+        request = self.client.post(
+            "/api/images/upload", {"name": file_name, "mimetype": "image/jpeg"}
+        )
+        self.assertEqual(request.status_code, status.HTTP_201_CREATED)
+
     def test_image_upload_endpoint(self):
         """
         Test image upload endpoint
@@ -288,8 +459,16 @@ class ImageTestCase(APITestCase):
             )
         ]
 
+        # Not uploaded yet, nothing to convert
+        with mock.patch("apps.images.views.convert_image") as task:
+            request = self.client.get(f"/api/images/{image_id}/?extension=png")
+        self.assertEqual(request.status_code, status.HTTP_200_OK)
+        self.assertIsNone(request.json()["presigned_url"])
+        task.s.assert_not_called()
+
         response = requests.request("POST", url, data=payload, files=files)
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.client.patch(f"/api/images/{image_id}/upload-finished/")
 
         # Get endpoint calling after upload, first uploaded file
         request = self.client.get(f"/api/images/{image_id}/")
@@ -301,26 +480,1086 @@ class ImageTestCase(APITestCase):
         res = requests.request("GET", response.get("presigned_url"))
         self.assertEqual(res.status_code, status.HTTP_200_OK)
 
-        # File conversion from jpg to jpeg
+        # File conversion from jpg to jpeg, queued for conversion
+        request = self.client.get(f"/api/images/{image_id}/?extension=jpeg")
+        response = request.json()
+        self.assertEqual(request.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response["status"], "Processing")
+        self.assertIsNone(response["presigned_url"])
+
+        # Run conversion task synchronously
+        convert_image(image_id, "jpeg")
         request = self.client.get(f"/api/images/{image_id}/?extension=jpeg")
         response = request.json()
         self.assertEqual(request.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response["available_extensions"]), 2)
         self.assertIn("jpeg", response["available_extensions"])
+        self.assertEqual(response["mimetype"], "image/jpeg")
         # Checking image url, if file found
         res = requests.request("GET", response.get("presigned_url"))
         self.assertEqual(res.status_code, status.HTTP_200_OK)
 
         # File conversion from jpg to png
         request = self.client.get(f"/api/images/{image_id}/?extension=png")
+        self.assertEqual(request.status_code, status.HTTP_202_ACCEPTED)
+
+        convert_image(image_id, "png")
+        request = self.client.get(f"/api/images/{image_id}/?extension=png")
         response = request.json()
         self.assertEqual(request.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response["available_extensions"]), 3)
         self.assertIn("png", response["available_extensions"])
-        # Checking image url, if file found
+        self.assertEqual(response["name"], "sample.png")
+        # Checking image url, if file found and encoded as png
         res = requests.request("GET", response.get("presigned_url"))
         self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertTrue(res.content.startswith(b"\x89PNG"))
 
         # File conversion, invalid extension only works for jpg, jpeg, png
         request = self.client.get(f"/api/images/{image_id}/?extension=gif")
         self.assertEqual(request.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_convert_image_single_flight(self):
+        """
+        Test concurrent conversions encode once and append extension once
+        """
+        image = Image.objects.create(
+            name="car.jpg",
+            mimetype="image/jpg",
+            available_extensions=["jpg"],
+            status=UploadStatus.UPLOADED,
+        )
+        with open("data/images/car.jpg", "rb") as fileobj:
+            upload_fileobj(image.key, fileobj)
+
+        # Conversion held by another task is skipped
+        with single_flight(image.get_key("png")):
+            convert_image(image.id, "png")
+        self.assertFalse(check_file_exists(image.get_key("png")))
+
+        # Stale instances append without overwriting or duplicating values
+        stale = Image.objects.get(id=image.id)
+        convert_image(image.id, "png")
+        self.assertFalse(stale.append_value("available_extensions", "png"))
+        self.assertTrue(stale.append_value("available_extensions", "jpeg"))
+        image.refresh_from_db()
+        self.assertEqual(image.available_extensions, ["jpg", "png", "jpeg"])
+
+        # Without the lock backend conversions are done, not skipped
+        with mock.patch("apps.contrib.cache.cache.add", return_value=None):
+            convert_image(image.id, "jpeg")
+        self.assertTrue(check_file_exists(image.get_key("jpeg")))
+
+    def test_async_image_endpoints(self):
+        """
+        Test async endpoints respond like the API endpoints
+        """
+        request = self.client.post(
+            "/api/async/images/upload", {"name": "sample.jpg", "mimetype": "image/jpg"}
+        )
+        self.assertEqual(request.status_code, status.HTTP_201_CREATED)
+        response = request.json()
+        image_id = response["id"]
+        self.assertEqual(response["status"], "Uploading")
+        self.assertIn("key", response["presigned_post_url"]["fields"])
+
+        request = self.client.post(
+            "/api/async/images/upload", {"name": "sample.gif", "mimetype": "image/gif"}
+        )
+        self.assertEqual(request.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Not uploaded yet
+        request = self.client.patch(f"/api/async/images/{image_id}/upload-finished/")
+        self.assertEqual(request.status_code, status.HTTP_200_OK)
+        self.assertEqual(request.json()["status"], "Uploading")
+
+        with open("data/images/car.jpg", "rb") as fileobj:
+            upload_fileobj(Image.objects.get(id=image_id).key, fileobj)
+        with self.assertNumQueries(2):
+            request = self.client.patch(
+                f"/api/async/images/{image_id}/upload-finished/"
+            )
+        self.assertEqual(request.json()["status"], "Uploaded")
+
+        with self.assertNumQueries(1):
+            request = self.client.get(f"/api/async/images/{image_id}/")
+        response = request.json()
+        self.assertEqual(request.status_code, status.HTTP_200_OK)
+        self.assertEqual(response, self.client.get(f"/api/images/{image_id}/").json())
+        self.assertTrue(requests.get(response["presigned_url"]).ok)
+
+        request = self.client.get(f"/api/async/images/{image_id}/?extension=png")
+        self.assertEqual(request.status_code, status.HTTP_202_ACCEPTED)
+        self.assertIsNone(request.json()["presigned_url"])
+
+        request = self.client.get(f"/api/async/images/{image_id}/?extension=gif")
+        self.assertEqual(request.status_code, status.HTTP_400_BAD_REQUEST)
+
+        request = self.client.delete(f"/api/async/images/{image_id}/")
+        self.assertEqual(request.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+        request = self.client.get(f"/api/async/images/{uuid4()}/")
+        self.assertEqual(request.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_image_wait_endpoint(self):
+        """
+        Test wait endpoint responds on status change, notification or timeout
+        """
+        image = Image.objects.create(name="car.jpg", mimetype="image/jpg")
+
+        # Status already different from the known one
+        with self.assertNumQueries(1):
+            request = self.client.get(
+                f"/api/async/images/{image.id}/wait/?status=uploaded"
+            )
+        self.assertEqual(request.status_code, status.HTTP_200_OK)
+        self.assertEqual(request.json()["status"], "Uploading")
+
+        # Unchanged status responds at timeout
+        start = time.monotonic()
+        request = self.client.get(f"/api/async/images/{image.id}/wait/?timeout=1")
+        self.assertGreaterEqual(time.monotonic() - start, 1)
+        self.assertEqual(request.json()["status"], "Uploading")
+
+        # Notifications wake the wait, image is read again. Test requests run on new
+        # event loops, image is also read again once the loop is subscribed
+        timer = threading.Timer(0.2, notify_changed, [[image.id]])
+        timer.start()
+        with self.assertNumQueries(3):
+            request = self.client.get(f"/api/async/images/{image.id}/wait/?timeout=1")
+        timer.join()
+        self.assertEqual(request.json()["status"], "Uploading")
+
+        request = self.client.get(
+            f"/api/async/images/{image.id}/wait/?status=Uploading"
+        )
+        self.assertEqual(request.status_code, status.HTTP_400_BAD_REQUEST)
+        request = self.client.get(f"/api/async/images/{uuid4()}/wait/?timeout=1")
+        self.assertEqual(request.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_image_delete_endpoints(self):
+        """
+        Test delete endpoints remove images and every object under images/{id}/
+        """
+        images = Image.objects.bulk_create(
+            Image(
+                name=f"sample-{i}.png",
+                mimetype="image/png",
+                available_extensions=["png", "jpg"],
+                status=UploadStatus.UPLOADED,
+            )
+            for i in range(3)
+        )
+        kept = Image.objects.create(name="kept.png", mimetype="image/png")
+        for image in [*images, kept]:
+            for key in (
+                image.key,
+                image.get_key("jpg"),
+                f"images/{image.id}/thumb.jpg",
+            ):
+                self.s3.put_object(Bucket=settings.AWS_BUCKET_NAME, Key=key)
+
+        with self.assertNumQueries(2):
+            request = self.client.delete(f"/api/images/{images[0].id}/")
+        self.assertEqual(request.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Image.objects.filter(id=images[0].id).exists())
+
+        request = self.client.delete(f"/api/images/{images[0].id}/")
+        self.assertEqual(request.status_code, status.HTTP_404_NOT_FOUND)
+
+        payload = {"ids": [str(image.id) for image in images[1:]] + [str(uuid4())]}
+        with self.assertNumQueries(2):
+            request = self.client.delete("/api/images/bulk/", payload)
+        self.assertEqual(request.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(list(Image.objects.all()), [kept])
+
+        request = self.client.delete("/api/images/bulk/", {"ids": []})
+        self.assertEqual(request.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Keys are deleted in batches
+        with mock.patch.object(storage, "DELETE_BATCH_SIZE", 2), mock.patch.object(
+            self.s3, "delete_objects", wraps=self.s3.delete_objects
+        ) as delete:
+            delete_image_objects([image.id for image in images])
+            self.assertEqual(delete.call_count, 5)
+
+        objects = self.s3.list_objects_v2(Bucket=settings.AWS_BUCKET_NAME)["Contents"]
+        self.assertEqual(
+            sorted(obj["Key"] for obj in objects),
+            sorted([kept.key, kept.get_key("jpg"), f"images/{kept.id}/thumb.jpg"]),
+        )
+
+    def test_deduplicate_image(self):
+        """
+        Test uploads of the same content share files and derivatives of the first one
+        """
+        images = Image.objects.bulk_create(
+            Image(
+                name=name,
+                mimetype="image/jpg",
+                available_extensions=["jpg"],
+                status=UploadStatus.UPLOADED,
+                created_at=timezone.now() + timedelta(seconds=i),
+            )
+            for i, name in enumerate(["car.jpg", "copy.jpg", "flower.jpg"])
+        )
+        canonical, duplicate, other = images
+        for image, path in zip(
+            images,
+            ["data/images/car.jpg", "data/images/car.jpg", "data/images/flower.png"],
+        ):
+            with open(path, "rb") as fileobj:
+                upload_fileobj(image.key, fileobj)
+
+        deduplicate_image(canonical.id)
+        convert_image(canonical.id, "png")
+        generate_renditions(canonical.id)
+        canonical.refresh_from_db()
+        self.assertEqual(len(canonical.content_hash), 64)
+        self.assertIsNone(canonical.canonical_id)
+
+        # Conversions of the duplicate done before hashing are deleted with the upload
+        convert_image(duplicate.id, "jpeg")
+        deduplicate_image(duplicate.id)
+        duplicate.refresh_from_db()
+        self.assertEqual(duplicate.content_hash, canonical.content_hash)
+        self.assertEqual(duplicate.canonical_id, canonical.id)
+        self.assertEqual(duplicate.key, canonical.key)
+        self.assertEqual(duplicate.available_extensions, ["jpg", "png"])
+        self.assertEqual(duplicate.available_renditions, canonical.available_renditions)
+        self.assertFalse(any(list_keys(f"images/{duplicate.id}/")))
+
+        # Shared derivatives are not encoded again
+        with mock.patch("apps.images.tasks.convert") as convert_mock:
+            convert_image(duplicate.id, "png")
+        convert_mock.assert_not_called()
+        request = self.client.get(f"/api/images/{duplicate.id}/?extension=png")
+        self.assertEqual(request.status_code, status.HTTP_200_OK)
+        self.assertTrue(requests.get(request.json()["presigned_url"]).ok)
+
+        deduplicate_image(other.id)
+        other.refresh_from_db()
+        self.assertIsNone(other.canonical_id)
+        self.assertNotEqual(other.content_hash, canonical.content_hash)
+
+        # Shared files are deleted with the last image using them
+        self.client.delete(f"/api/images/{canonical.id}/")
+        delete_image_objects([canonical.id])
+        self.assertTrue(check_file_exists(duplicate.key))
+        self.client.delete(f"/api/images/{duplicate.id}/")
+        delete_image_objects([duplicate.storage_id])
+        self.assertFalse(check_file_exists(duplicate.key))
+        self.assertTrue(check_file_exists(other.key))
+
+    def test_extract_metadata(self):
+        """
+        Test metadata is read from headers of uploaded files, invalid files are errors
+        """
+        images = Image.objects.bulk_create(
+            Image(name=name, mimetype="image/jpg", status=UploadStatus.UPLOADED)
+            for name in ["car.jpg", "rotated.jpg", "text.jpg"]
+        )
+        car, rotated, text = images
+        noise = Image.objects.create(
+            name="noise.png", mimetype="image/png", status=UploadStatus.UPLOADED
+        )
+        with open("data/images/car.jpg", "rb") as fileobj:
+            content = fileobj.read()
+        upload_fileobj(car.key, BytesIO(content))
+        exif = PILImage.Exif()
+        exif[0x0112] = 6
+        output = BytesIO()
+        PILImage.new("RGB", (40, 30)).save(output, "JPEG", exif=exif)
+        output.seek(0)
+        upload_fileobj(rotated.key, output)
+        upload_fileobj(text.key, BytesIO(b"not an image"))
+
+        with mock.patch.object(
+            self.s3, "get_object", wraps=self.s3.get_object
+        ) as get_object:
+            self.assertTrue(extract_metadata(car.id))
+            self.assertEqual(get_object.call_args.kwargs["Range"], "bytes=0-65535")
+        car.refresh_from_db()
+        self.assertEqual(
+            (car.format, car.width, car.height, car.size, car.orientation),
+            ("JPEG", 1024, 768, len(content), None),
+        )
+
+        # Whole file is read, if header is bigger
+        with self.settings(IMAGE_HEADER_SIZE=16):
+            self.assertTrue(extract_metadata(rotated.id))
+        rotated.refresh_from_db()
+        self.assertEqual(
+            (rotated.width, rotated.height, rotated.orientation), (40, 30, 6)
+        )
+
+        # PNG pixels after the header are not needed
+        output = BytesIO()
+        PILImage.frombytes("RGB", (200, 200), os.urandom(200 * 200 * 3)).save(
+            output, "PNG"
+        )
+        self.assertGreater(output.tell(), settings.IMAGE_HEADER_SIZE)
+        output.seek(0)
+        upload_fileobj(noise.key, output)
+        with mock.patch("apps.images.tasks.download_fileobj") as download:
+            self.assertTrue(extract_metadata(noise.id))
+        download.assert_not_called()
+        noise.refresh_from_db()
+        self.assertEqual(
+            (noise.format, noise.width, noise.height, noise.orientation),
+            ("PNG", 200, 200, None),
+        )
+        output = BytesIO()
+        PILImage.new("RGB", (40, 30)).save(output, "PNG", exif=exif)
+        output.seek(0)
+        self.assertEqual(read_metadata(output)["orientation"], 6)
+
+        self.assertFalse(extract_metadata(text.id))
+        text.refresh_from_db()
+        self.assertEqual(text.status, UploadStatus.ERROR)
+        self.assertIn("Not a valid image", text.message)
+
+        # Original fitting a rendition is stored as is
+        generate_renditions(car.id)
+        with download_fileobj(car.get_rendition_key("large")) as fileobj:
+            self.assertEqual(fileobj.read(), content)
+
+        response = self.client.get(f"/api/images/{car.id}/").json()
+        self.assertEqual((response["width"], response["height"]), (1024, 768))
+
+    def test_image_convert(self):
+        """
+        Test image encoding, palette png to jpeg and jpeg to png
+        """
+        with open("data/images/flower.png", "rb") as fileobj:
+            output = convert(fileobj, "jpeg")
+        with PILImage.open(output) as image:
+            self.assertEqual(image.format, "JPEG")
+            self.assertEqual(image.mode, "RGB")
+            self.assertEqual(image.size, (360, 530))
+
+        with open("data/images/car.jpg", "rb") as fileobj:
+            output = convert(fileobj, "png")
+        with PILImage.open(output) as image:
+            self.assertEqual(image.format, "PNG")
+            self.assertEqual(image.size, (1024, 768))
+
+        # Orientation is applied, same format is copied with its EXIF
+        exif = PILImage.Exif()
+        exif[0x0112] = 6
+        original = BytesIO()
+        PILImage.new("RGB", (40, 30)).save(original, "JPEG", exif=exif)
+        original.seek(0)
+        with PILImage.open(convert(original, "png")) as image:
+            self.assertEqual(image.size, (30, 40))
+        original.seek(0)
+        self.assertEqual(convert(original, "jpeg").read(), original.getvalue())
+
+    def test_image_decoding_limits(self):
+        """
+        Test images over decoding limits are set to error, JPEGs are decoded at scale
+        """
+        with open("data/images/car.jpg", "rb") as fileobj, open_image(
+            fileobj, (200, 200)
+        ) as image:
+            image.load()
+            self.assertEqual(image.size, (512, 384))
+        with open("data/images/flower.png", "rb") as fileobj, open_image(
+            fileobj, (200, 200)
+        ) as image:
+            self.assertEqual(image.size, (360, 530))
+
+        image = Image.objects.create(
+            name="car.jpg",
+            mimetype="image/jpg",
+            available_extensions=["jpg"],
+            status=UploadStatus.UPLOADED,
+        )
+        with open("data/images/car.jpg", "rb") as fileobj:
+            upload_fileobj(image.key, fileobj)
+
+        # Header dimensions are checked before decoding
+        with self.settings(IMAGE_MAX_PIXELS=1024 * 767):
+            self.assertFalse(extract_metadata(image.id))
+            image.refresh_from_db()
+            self.assertEqual(image.status, UploadStatus.ERROR)
+            self.assertEqual(
+                image.message, "Image has 786432 pixels, maximum is 785408"
+            )
+
+            Image.objects.filter(id=image.id).update(status=UploadStatus.UPLOADED)
+            convert_image(image.id, "png")
+            image.refresh_from_db()
+            self.assertEqual(image.status, UploadStatus.ERROR)
+            self.assertFalse(check_file_exists(image.get_key("png")))
+
+        # Small files with many pixels are rejected before their pixels are loaded
+        bomb = Image.objects.create(
+            name="bomb.png", mimetype="image/png", status=UploadStatus.UPLOADED
+        )
+        output = BytesIO()
+        PILImage.new("1", (9000, 9000)).save(output, "PNG")
+        self.assertLess(output.tell(), settings.IMAGE_HEADER_SIZE)
+        output.seek(0)
+        upload_fileobj(bomb.key, output)
+        with mock.patch("PIL.ImageFile.ImageFile.load") as load:
+            self.assertFalse(extract_metadata(bomb.id))
+        load.assert_not_called()
+        bomb.refresh_from_db()
+        self.assertEqual(bomb.status, UploadStatus.ERROR)
+        self.assertIn("Image has 81000000 pixels", bomb.message)
+
+        # Tasks over time limit
+        Image.objects.filter(id=image.id).update(status=UploadStatus.UPLOADED)
+        with mock.patch(
+            "apps.images.tasks.resize", side_effect=SoftTimeLimitExceeded()
+        ):
+            resize_image(image.id, 100, 100)
+        image.refresh_from_db()
+        self.assertEqual(image.status, UploadStatus.ERROR)
+        self.assertEqual(image.message, "Time limit exceeded while decoding")
+
+        # Images in error are not queued for conversion again
+        with mock.patch("apps.images.views.convert_image") as task:
+            request = self.client.get(f"/api/images/{image.id}/?extension=png")
+        self.assertEqual(request.status_code, status.HTTP_200_OK)
+        self.assertEqual(request.json()["status"], "Error")
+        self.assertIsNone(request.json()["presigned_url"])
+        task.s.assert_not_called()
+
+    def test_image_resize(self):
+        """
+        Test resize fits images into the box or fills it, without upscaling
+        """
+        image = PILImage.new("RGB", (1024, 768))
+        self.assertEqual(resize(image, 200, 200).size, (200, 150))
+        self.assertEqual(resize(image, 200, 200, fit="cover").size, (200, 200))
+        self.assertEqual(resize(image, 2000, 2000).size, (1024, 768))
+        self.assertEqual(resize(image, 2000, 1000, fit="cover").size, (1024, 512))
+
+    def test_generate_renditions(self):
+        """
+        Test renditions are generated from original and listed with pre-signed urls
+        """
+        image = Image.objects.create(
+            name="car.jpg",
+            mimetype="image/jpg",
+            available_extensions=["jpg"],
+            status=UploadStatus.UPLOADED,
+        )
+        with open("data/images/car.jpg", "rb") as fileobj:
+            upload_fileobj(image.key, fileobj)
+
+        generate_renditions(image.id)
+        image.refresh_from_db()
+        self.assertEqual(image.available_renditions, ["thumb", "medium", "large"])
+        self.assertIsNone(image.message)
+
+        sizes = {"thumb": (200, 200), "medium": (800, 600), "large": (1024, 768)}
+        for name, size in sizes.items():
+            with download_fileobj(image.get_rendition_key(name)) as fileobj:
+                with PILImage.open(fileobj) as rendition:
+                    self.assertEqual(rendition.format, "JPEG")
+                    self.assertEqual(rendition.size, size)
+
+        # Generated renditions are skipped
+        with self.assertNumQueries(1):
+            generate_renditions(image.id)
+
+        request = self.client.get(f"/api/images/{image.id}/")
+        renditions = request.json()["renditions"]
+        self.assertEqual(set(renditions), set(sizes))
+        self.assertTrue(requests.get(renditions["thumb"]).ok)
+
+    def test_image_resize_endpoint(self):
+        """
+        Test resize endpoint queues resize once and gives pre-signed url when stored
+        """
+        image = Image.objects.create(
+            name="car.jpg",
+            mimetype="image/jpg",
+            available_extensions=["jpg"],
+            status=UploadStatus.UPLOADED,
+        )
+        with open("data/images/car.jpg", "rb") as fileobj:
+            upload_fileobj(image.key, fileobj)
+
+        url = (
+            f"/api/images/{image.id}/resize/"
+            "?width=300&height=100&fit=cover&extension=png"
+        )
+        request = self.client.get(url)
+        self.assertEqual(request.status_code, status.HTTP_202_ACCEPTED)
+        self.assertIsNone(request.json()["presigned_url"])
+
+        # Variant being encoded by another task is skipped
+        key = image.get_variant_key("png", width=300, height=100, fit="cover")
+        with single_flight(key) as acquired:
+            self.assertTrue(acquired)
+            resize_image(image.id, 300, 100, "cover", None, "png")
+            self.assertFalse(check_file_exists(key))
+
+        resize_image(image.id, 300, 100, "cover", None, "png")
+        request = self.client.get(url)
+        self.assertEqual(request.status_code, status.HTTP_200_OK)
+        response = request.json()
+        self.assertEqual(response["name"], "car.png")
+
+        with PILImage.open(
+            BytesIO(requests.get(response["presigned_url"]).content)
+        ) as resized:
+            self.assertEqual(resized.format, "PNG")
+            self.assertEqual(resized.size, (300, 100))
+
+        request = self.client.get(
+            f"/api/images/{image.id}/resize/?width=5000&height=100"
+        )
+        self.assertEqual(request.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Polls before the variant exists queue one resize
+        with mock.patch("apps.images.views.resize_image") as task:
+            for _ in range(3):
+                request = self.client.get(
+                    f"/api/images/{image.id}/resize/?width=200&height=100"
+                )
+                self.assertEqual(request.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(task.s.call_count, 1)
+
+        # Nothing to resize before the upload finished
+        pending = Image.objects.create(name="car.jpg", mimetype="image/jpg")
+        with mock.patch("apps.images.views.resize_image") as task:
+            request = self.client.get(
+                f"/api/images/{pending.id}/resize/?width=300&height=100"
+            )
+        self.assertEqual(request.status_code, status.HTTP_200_OK)
+        self.assertIsNone(request.json()["presigned_url"])
+        task.s.assert_not_called()
+
+    def test_image_list_endpoint(self):
+        """
+        Test image list endpoint signs a page in one pass, with fixed query count and
+        latency budget
+        """
+        Image.objects.bulk_create(
+            Image(
+                name=f"sample-{i}.png",
+                mimetype="image/png",
+                available_extensions=["png"],
+                status=UploadStatus.UPLOADED,
+            )
+            for i in range(60)
+        )
+
+        with mock.patch.object(
+            self.s3, "generate_presigned_url", wraps=self.s3.generate_presigned_url
+        ) as sign:
+            start = time.monotonic()
+            with self.assertNumQueries(1):
+                request = self.client.get("/api/images/")
+            elapsed = time.monotonic() - start
+            self.assertEqual(sign.call_count, 1)
+
+        response = request.json()
+        self.assertEqual(request.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response["results"]), 50)
+        self.assertLess(elapsed, 0.5)
+        for data in response["results"]:
+            self.assertEqual(data["status"], "Uploaded")
+            image = Image(id=data["id"], name=data["name"])
+            self.assertIn(f"/{image.key}?", data["presigned_url"])
+
+    def test_image_list_pagination(self):
+        """
+        Test image list keyset pagination, next and previous pages with same created_at
+        """
+        Image.objects.bulk_create(
+            Image(name=f"sample-{i}.png", mimetype="image/png") for i in range(120)
+        )
+        # Rows with same timestamp are ordered by id
+        Image.objects.filter(
+            id__in=Image.objects.order_by("?").values("id")[:40]
+        ).update(created_at=timezone.now())
+        ids = list(
+            Image.objects.order_by("-created_at", "-id").values_list("id", flat=True)
+        )
+
+        request = self.client.get("/api/images/")
+        first_page = request.json()
+        self.assertEqual(request.status_code, status.HTTP_200_OK)
+        self.assertIsNone(first_page["previous"])
+        self.assertEqual(
+            [d["id"] for d in first_page["results"]], [str(i) for i in ids[:50]]
+        )
+
+        request = self.client.get(first_page["next"])
+        second_page = request.json()
+        self.assertEqual(
+            [d["id"] for d in second_page["results"]], [str(i) for i in ids[50:100]]
+        )
+
+        request = self.client.get(second_page["next"])
+        last_page = request.json()
+        self.assertIsNone(last_page["next"])
+        self.assertEqual(
+            [d["id"] for d in last_page["results"]], [str(i) for i in ids[100:]]
+        )
+
+        # Going back
+        request = self.client.get(last_page["previous"])
+        self.assertEqual(request.json()["results"], second_page["results"])
+        request = self.client.get(second_page["previous"])
+        self.assertEqual(request.json()["results"], first_page["results"])
+        self.assertIsNone(request.json()["previous"])
+
+        request = self.client.get("/api/images/?cursor=invalid")
+        self.assertEqual(request.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_image_list_filters(self):
+        """
+        Test image list filters by status, extension and created time range
+        """
+        uploading = Image.objects.create(name="uploading.png", mimetype="image/png")
+        converted = Image.objects.create(
+            name="converted.jpg",
+            mimetype="image/jpg",
+            status=UploadStatus.UPLOADED,
+            available_extensions=["jpg", "png"],
+        )
+        failed = Image.objects.create(
+            name="failed.jpg", mimetype="image/jpg", status=UploadStatus.ERROR
+        )
+        Image.objects.filter(id=uploading.id).update(
+            created_at=timezone.now() - timedelta(hours=1)
+        )
+
+        def list_ids(query):
+            request = self.client.get(f"/api/images/?{query}")
+            self.assertEqual(request.status_code, status.HTTP_200_OK)
+            return {data["id"] for data in request.json()["results"]}
+
+        self.assertEqual(list_ids("status=uploading"), {str(uploading.id)})
+        self.assertEqual(list_ids("status=error"), {str(failed.id)})
+        self.assertEqual(list_ids("extension=png"), {str(converted.id)})
+        before = (timezone.now() - timedelta(minutes=30)).isoformat()
+        self.assertEqual(
+            list_ids(urlencode({"created_before": before})), {str(uploading.id)}
+        )
+        self.assertEqual(
+            list_ids(urlencode({"created_after": before, "status": "error"})),
+            {str(failed.id)},
+        )
+
+        request = self.client.get("/api/images/?status=unknown")
+        self.assertEqual(request.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_image_bulk_upload_endpoint(self):
+        """
+        Test image bulk upload endpoint, creates all images with one insert, uploads
+        are verified by the upload sweep
+        """
+        payload = {
+            "images": [
+                {"name": "car.jpg", "mimetype": "image/jpg"},
+                {"name": "flower.png", "mimetype": "image/png"},
+                {"name": "missing.png", "mimetype": "image/png"},
+            ]
+        }
+        with self.assertNumQueries(1):
+            request = self.client.post("/api/images/upload/bulk", payload)
+        response = request.json()
+        self.assertEqual(request.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response), 3)
+        self.assertEqual(
+            [data["available_extensions"] for data in response],
+            [["jpg"], ["png"], ["png"]],
+        )
+
+        # Upload first two images
+        for data, path in zip(
+            response, ("data/images/car.jpg", "data/images/flower.png")
+        ):
+            fields = data["presigned_post_url"]["fields"]
+            files = [("file", (fields["key"], open(path, "rb"), data["mimetype"]))]
+            res = requests.request(
+                "POST", data["presigned_post_url"]["url"], data=fields, files=files
+            )
+            self.assertEqual(res.status_code, status.HTTP_204_NO_CONTENT)
+
+        Image.objects.update(created_at=timezone.now() - timedelta(hours=1))
+        sweep_image_uploads()
+        self.assertEqual(
+            [Image.objects.get(id=data["id"]).status for data in response],
+            [UploadStatus.UPLOADED, UploadStatus.UPLOADED, UploadStatus.ERROR],
+        )
+
+        # Validation of every image and maximum size
+        payload = {"images": [{"name": "sample.gif", "mimetype": "image/png"}]}
+        request = self.client.post("/api/images/upload/bulk", payload)
+        self.assertEqual(request.status_code, status.HTTP_400_BAD_REQUEST)
+        with self.settings(IMAGE_BULK_UPLOAD_MAX_SIZE=2):
+            payload = {"images": [{"name": "car.jpg", "mimetype": "image/jpg"}] * 3}
+            request = self.client.post("/api/images/upload/bulk", payload)
+            self.assertEqual(request.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_image_endpoints_query_count(self):
+        """
+        Test upload, upload finished and get endpoints only run the queries they need
+        """
+        with self.assertNumQueries(1):
+            request = self.client.post(
+                "/api/images/upload", {"name": "car.jpg", "mimetype": "image/jpg"}
+            )
+        response = request.json()
+        self.assertEqual(request.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response["available_extensions"], ["jpg"])
+        image_id = response["id"]
+        key = response["presigned_post_url"]["fields"]["key"]
+
+        with self.assertNumQueries(1):
+            request = self.client.get(f"/api/images/{image_id}/")
+        self.assertEqual(request.status_code, status.HTTP_200_OK)
+
+        with open("data/images/car.jpg", "rb") as fileobj:
+            upload_fileobj(key, fileobj)
+        with self.assertNumQueries(2):
+            request = self.client.patch(f"/api/images/{image_id}/upload-finished/")
+        self.assertEqual(request.status_code, status.HTTP_200_OK)
+        self.assertEqual(request.json()["status"], "Uploaded")
+
+        # Already uploaded images are skipped
+        with self.assertNumQueries(1):
+            process_image_upload(image_id)
+
+        Image.objects.filter(id=image_id).update(status=UploadStatus.UPLOADING)
+        image = Image.objects.get(id=image_id)
+        with self.assertNumQueries(2):
+            process_image_upload(image_id)
+        self.assertEqual(Image.objects.get(id=image_id).status, UploadStatus.UPLOADED)
+        self.assertEqual(
+            Image.objects.get(id=image_id).updated_at > image.updated_at, True
+        )
+
+    def test_image_get_endpoint_cache(self):
+        """
+        Test get endpoint responses are cached until image changes, with ETag support
+        """
+        request = self.client.post(
+            "/api/images/upload", {"name": "car.jpg", "mimetype": "image/jpg"}
+        )
+        image_id = request.json()["id"]
+        key = request.json()["presigned_post_url"]["fields"]["key"]
+
+        with self.assertNumQueries(1):
+            request = self.client.get(f"/api/images/{image_id}/")
+        etag = request["ETag"]
+        self.assertEqual(request.json()["status"], "Uploading")
+
+        # Polling is served from cache, unchanged responses are not sent again
+        with self.assertNumQueries(0):
+            request = self.client.get(f"/api/images/{image_id}/")
+        self.assertEqual(request.status_code, status.HTTP_200_OK)
+        self.assertEqual(request["ETag"], etag)
+        with self.assertNumQueries(0):
+            request = self.client.get(
+                f"/api/images/{image_id}/", HTTP_IF_NONE_MATCH=etag
+            )
+        self.assertEqual(request.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(request["ETag"], etag)
+
+        # Async endpoint shares cached responses and ETags
+        with self.assertNumQueries(0):
+            request = self.client.get(
+                f"/api/async/images/{image_id}/", HTTP_IF_NONE_MATCH=etag
+            )
+        self.assertEqual(request.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(request["ETag"], etag)
+        request = self.client.get(f"/api/async/images/{image_id}/?extension=png")
+        self.assertEqual(request.status_code, status.HTTP_200_OK)
+        self.assertIsNone(request.json()["presigned_url"])
+        self.assertEqual(
+            self.client.get(f"/api/images/{image_id}/?extension=png")["ETag"],
+            request["ETag"],
+        )
+
+        # Upload finished changes the image, cached response is dropped
+        with open("data/images/car.jpg", "rb") as fileobj:
+            upload_fileobj(key, fileobj)
+        self.client.patch(f"/api/images/{image_id}/upload-finished/")
+        request = self.client.get(f"/api/images/{image_id}/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(request.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(request["ETag"], etag)
+        self.assertEqual(request.json()["status"], "Uploaded")
+
+        # Updates in tasks and deletes drop cached responses too
+        Image.objects.filter(id=image_id).update(status=UploadStatus.UPLOADING)
+        process_image_upload(image_id)
+        self.assertEqual(
+            self.client.get(f"/api/images/{image_id}/").json()["status"], "Uploaded"
+        )
+        self.client.delete("/api/images/bulk/", {"ids": [image_id]}, format="json")
+        request = self.client.get(f"/api/images/{image_id}/")
+        self.assertEqual(request.status_code, status.HTTP_404_NOT_FOUND)
+        request = self.client.get("/api/images/not-an-id/")
+        self.assertEqual(request.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(AWS_EVENTS_AUTH_TOKEN="secret")
+    def test_image_upload_events_endpoint(self):
+        """
+        Test bucket event notifications endpoint sets uploaded status, with MinIO
+        webhook payload
+        """
+        image = Image.objects.create(name="car.jpg", mimetype="image/jpg")
+        other = Image.objects.create(name="flower.png", mimetype="image/png")
+
+        def record(key, bucket=settings.AWS_BUCKET_NAME, event="s3:ObjectCreated:Post"):
+            return {
+                "eventName": event,
+                "s3": {"bucket": {"name": bucket}, "object": {"key": quote_plus(key)}},
+            }
+
+        payload = {
+            "EventName": "s3:ObjectCreated:Post",
+            "Key": f"{settings.AWS_BUCKET_NAME}/{image.key}",
+            "Records": [
+                record(image.key),
+                record(other.key, bucket="other"),
+                record(other.get_key("jpg")),
+                record(other.key, event="s3:ObjectRemoved:Delete"),
+            ],
+        }
+
+        request = self.client.post("/api/images/upload/events", payload)
+        self.assertEqual(request.status_code, status.HTTP_403_FORBIDDEN)
+        request = self.client.post(
+            "/api/images/upload/events", payload, HTTP_AUTHORIZATION="Bearer wrong"
+        )
+        self.assertEqual(request.status_code, status.HTTP_403_FORBIDDEN)
+
+        request = self.client.post(
+            "/api/images/upload/events", payload, HTTP_AUTHORIZATION="Bearer secret"
+        )
+        self.assertEqual(request.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(Image.objects.get(id=image.id).status, UploadStatus.UPLOADED)
+        self.assertEqual(Image.objects.get(id=other.id).status, UploadStatus.UPLOADING)
+        self.assertEqual(check_file_exists(image.key), True)
+
+        # Webhook is disabled without a token
+        with self.settings(AWS_EVENTS_AUTH_TOKEN=None):
+            request = self.client.post(
+                "/api/images/upload/events", payload, HTTP_AUTHORIZATION="Bearer "
+            )
+            self.assertEqual(request.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_image_upload_size_limits(self):
+        """
+        Test uploads are limited by size and content type, oversized files are rejected
+        """
+        request = self.client.post(
+            "/api/images/upload", {"name": "car.jpg", "mimetype": "image/jpg"}
+        )
+        fields = request.json()["presigned_post_url"]["fields"]
+        self.assertEqual(fields["Content-Type"], "image/jpg")
+        policy = json.loads(base64.b64decode(fields["policy"]))
+        self.assertIn({"Content-Type": "image/jpg"}, policy["conditions"])
+        self.assertIn(
+            ["content-length-range", 1, settings.IMAGE_UPLOAD_MAX_SIZES["image/jpg"]],
+            policy["conditions"],
+        )
+
+        # Verification rejects and deletes files over the limit
+        image = Image.objects.get(id=request.json()["id"])
+        with open("data/images/car.jpg", "rb") as fileobj:
+            upload_fileobj(image.key, fileobj)
+        with self.settings(IMAGE_UPLOAD_MAX_SIZES={"image/jpg": 1024}):
+            process_image_upload(image.id)
+        image.refresh_from_db()
+        self.assertEqual(image.status, UploadStatus.ERROR)
+        self.assertEqual(image.message, "File too large")
+        self.assertEqual(image.size, os.path.getsize("data/images/car.jpg"))
+        self.assertFalse(check_file_exists(image.key))
+
+        # Metadata extraction doesn't decode them either
+        image = Image.objects.create(name="car.jpg", mimetype="image/jpg")
+        with open("data/images/car.jpg", "rb") as fileobj:
+            upload_fileobj(image.key, fileobj)
+        with self.settings(IMAGE_UPLOAD_MAX_SIZES={"image/jpg": 1024}):
+            with mock.patch("apps.images.tasks.read_metadata") as read_metadata:
+                self.assertFalse(extract_metadata(image.id))
+            read_metadata.assert_not_called()
+        self.assertEqual(Image.objects.get(id=image.id).message, "File too large")
+
+        # Multipart uploads declare their size
+        with self.settings(IMAGE_UPLOAD_MAX_SIZES={"image/png": 1024}):
+            request = self.client.post(
+                "/api/images/upload/multipart",
+                {"name": "flower.png", "mimetype": "image/png", "size": 1025},
+            )
+        self.assertEqual(request.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_image_multipart_upload_endpoints(self):
+        """
+        Test multipart upload, parts are uploaded with pre-signed part urls and resumed
+        """
+        with open("data/images/car.jpg", "rb") as fileobj:
+            # Trailing bytes are ignored by image decoders,
+            # first part is 5MB (S3 minimum)
+            content = fileobj.read() + bytes(5 * 1024 * 1024)
+
+        with self.settings(IMAGE_MULTIPART_PART_SIZE=5 * 1024 * 1024):
+            request = self.client.post(
+                "/api/images/upload/multipart",
+                {"name": "car.jpg", "mimetype": "image/jpg", "size": len(content)},
+            )
+        self.assertEqual(request.status_code, status.HTTP_201_CREATED)
+        response = request.json()
+        image_id, part_size = response["id"], response["part_size"]
+        self.assertEqual(response["status"], "Uploading")
+        self.assertEqual(part_size, 5 * 1024 * 1024)
+        self.assertEqual(response["parts_count"], 2)
+        self.assertIsNotNone(Image.objects.get(id=image_id).upload_id)
+
+        # First part uploaded, upload fails and resumes from listed parts
+        request = self.client.post(
+            f"/api/images/upload/multipart/{image_id}/parts",
+            {"part_numbers": [1, 2]},
+            format="json",
+        )
+        urls = request.json()["urls"]
+        self.assertTrue(requests.put(urls["1"], data=content[:part_size]).ok)
+        request = self.client.get(f"/api/images/upload/multipart/{image_id}")
+        self.assertEqual([part["part_number"] for part in request.json()], [1])
+        self.assertEqual(request.json()[0]["size"], part_size)
+        self.assertTrue(requests.put(urls["2"], data=content[part_size:]).ok)
+
+        request = self.client.post(f"/api/images/upload/multipart/{image_id}/complete")
+        self.assertEqual(request.status_code, status.HTTP_200_OK)
+        self.assertEqual(request.json()["status"], "Uploaded")
+        image = Image.objects.get(id=image_id)
+        self.assertIsNone(image.upload_id)
+        with download_fileobj(image.key) as fileobj:
+            self.assertEqual(fileobj.read(), content)
+
+        # Completed uploads have no multipart endpoints
+        request = self.client.post(f"/api/images/upload/multipart/{image_id}/complete")
+        self.assertEqual(request.status_code, status.HTTP_404_NOT_FOUND)
+
+        request = self.client.post(
+            "/api/images/upload/multipart",
+            {"name": "car.jpg", "mimetype": "image/jpg", "size": 0},
+        )
+        self.assertEqual(request.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_image_multipart_upload_abort(self):
+        """
+        Test multipart uploads are aborted by clients or by the upload sweep
+        """
+        request = self.client.post(
+            "/api/images/upload/multipart",
+            {"name": "car.jpg", "mimetype": "image/jpg", "size": 100},
+        )
+        image_id = request.json()["id"]
+
+        # Nothing uploaded
+        request = self.client.post(f"/api/images/upload/multipart/{image_id}/complete")
+        self.assertEqual(request.status_code, status.HTTP_400_BAD_REQUEST)
+
+        request = self.client.delete(f"/api/images/upload/multipart/{image_id}")
+        self.assertEqual(request.status_code, status.HTTP_204_NO_CONTENT)
+        image = Image.objects.get(id=image_id)
+        self.assertEqual(image.status, UploadStatus.ERROR)
+        self.assertEqual(image.message, "Upload aborted")
+        self.assertEqual(
+            self.s3.list_multipart_uploads(Bucket=settings.AWS_BUCKET_NAME).get(
+                "Uploads"
+            ),
+            None,
+        )
+
+        # Multipart uploads are swept after IMAGE_MULTIPART_SWEEP_AGE only
+        request = self.client.post(
+            "/api/images/upload/multipart",
+            {"name": "car.jpg", "mimetype": "image/jpg", "size": 100},
+        )
+        image_id = request.json()["id"]
+        Image.objects.filter(id=image_id).update(
+            created_at=timezone.now() - timedelta(hours=1)
+        )
+        sweep_image_uploads()
+        self.assertEqual(Image.objects.get(id=image_id).status, UploadStatus.UPLOADING)
+
+        Image.objects.filter(id=image_id).update(
+            created_at=timezone.now() - timedelta(days=2)
+        )
+        sweep_image_uploads()
+        image = Image.objects.get(id=image_id)
+        self.assertEqual(image.status, UploadStatus.ERROR)
+        self.assertIsNone(image.upload_id)
+        self.assertEqual(
+            self.s3.list_multipart_uploads(Bucket=settings.AWS_BUCKET_NAME).get(
+                "Uploads"
+            ),
+            None,
+        )
+
+        # Deleted images abort their unfinished uploads, in background
+        for url in ("/api/images/{}/", "/api/images/bulk/"):
+            request = self.client.post(
+                "/api/images/upload/multipart",
+                {"name": "car.jpg", "mimetype": "image/jpg", "size": 100},
+            )
+            image_id = request.json()["id"]
+            with mock.patch("apps.images.views.delete_image_objects") as task:
+                request = self.client.delete(
+                    url.format(image_id), {"ids": [image_id]}, format="json"
+                )
+            self.assertEqual(request.status_code, status.HTTP_204_NO_CONTENT)
+            delete_image_objects(*task.s.call_args.args)
+            self.assertEqual(
+                self.s3.list_multipart_uploads(Bucket=settings.AWS_BUCKET_NAME).get(
+                    "Uploads"
+                ),
+                None,
+            )
+
+    def test_sweep_image_uploads(self):
+        """
+        Test upload sweep verifies old uploading images by listing the bucket
+        """
+        uploaded = Image.objects.create(name="car.jpg", mimetype="image/jpg")
+        missing = Image.objects.create(name="flower.png", mimetype="image/png")
+        recent = Image.objects.create(name="recent.png", mimetype="image/png")
+        Image.objects.exclude(id=recent.id).update(
+            created_at=timezone.now() - timedelta(hours=1)
+        )
+        for image in (uploaded, recent):
+            self.s3.put_object(Bucket=settings.AWS_BUCKET_NAME, Key=image.key)
+        self.s3.put_object(Bucket=settings.AWS_BUCKET_NAME, Key=missing.get_key("jpg"))
+
+        with mock.patch.object(self.s3, "head_object") as head_object:
+            with self.assertNumQueries(3):
+                sweep_image_uploads()
+            head_object.assert_not_called()
+
+        self.assertEqual(
+            Image.objects.get(id=uploaded.id).status, UploadStatus.UPLOADED
+        )
+        self.assertEqual(Image.objects.get(id=missing.id).status, UploadStatus.ERROR)
+        self.assertEqual(Image.objects.get(id=recent.id).status, UploadStatus.UPLOADING)
+
+        # Keys not reached within the listing budget are checked one by one
+        Image.objects.filter(id=uploaded.id).update(status=UploadStatus.UPLOADING)
+        with override_settings(IMAGE_UPLOAD_SWEEP_MAX_PAGES=1), mock.patch(
+            "apps.images.tasks.list_keys", return_value=iter([[], []])
+        ):
+            sweep_image_uploads()
+        self.assertEqual(
+            Image.objects.get(id=uploaded.id).status, UploadStatus.UPLOADED
+        )
+
+        # Sweeps do not overlap
+        Image.objects.filter(id=uploaded.id).update(status=UploadStatus.UPLOADING)
+        with single_flight("sweep-image-uploads"):
+            sweep_image_uploads()
+        self.assertEqual(
+            Image.objects.get(id=uploaded.id).status, UploadStatus.UPLOADING
+        )
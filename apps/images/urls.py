@@ -9,6 +9,38 @@ router.register("", views.ImageViewSet)
 
 urlpatterns = [
     path(r"", include(router.urls)),
+    path(
+        "upload/multipart/<uuid:pk>/parts",
+        views.ImageMultipartUploadViewSet.as_view({"post": "parts"}),
+        name="image-upload-multipart-parts",
+    ),
+    path(
+        "upload/multipart/<uuid:pk>/complete",
+        views.ImageMultipartUploadViewSet.as_view({"post": "complete"}),
+        name="image-upload-multipart-complete",
+    ),
+    path(
+        "upload/multipart/<uuid:pk>",
+        views.ImageMultipartUploadViewSet.as_view(
+            {"get": "retrieve", "delete": "destroy"}
+        ),
+        name="image-upload-multipart-detail",
+    ),
+    path(
+        "upload/multipart",
+        views.ImageMultipartUploadViewSet.as_view({"post": "create"}),
+        name="image-upload-multipart",
+    ),
+    url(
+        r"upload/events",
+        views.ImageUploadEventViewSet.as_view({"post": "create"}),
+        name="image-upload-events",
+    ),
+    url(
+        r"upload/bulk",
+        views.ImageUploadViewSet.as_view({"post": "bulk_create"}),
+        name="image-upload-bulk",
+    ),
     url(
         r"upload",
         views.ImageUploadViewSet.as_view({"post": "create"}),
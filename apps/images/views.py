@@ -1,27 +1,59 @@
+import hashlib
+import hmac
+import json
+from uuid import UUID
+
 from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.http import parse_etags, quote_etag
 from drf_spectacular.utils import extend_schema
 from rest_framework import status
 from rest_framework.decorators import action
-from rest_framework.exceptions import ValidationError
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
 from rest_framework.mixins import CreateModelMixin
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
 
+from apps.contrib.backends import UploadError
+from apps.contrib.pagination import KeysetPagination
+from apps.contrib.serializers import S3EventSerializer
 from apps.contrib.storage import (
+    abort_multipart_upload,
     check_file_exists,
+    complete_multipart_upload,
+    generate_presigned_part_urls,
     generate_presigned_url,
-    download_fileobj,
-    upload_fileobj,
+    get_event_keys,
+    list_uploaded_parts,
 )
-from apps.images.choices import UploadStatus
+from apps.images.cache import get_responses, set_responses
+from apps.images.choices import CONVERTIBLE_STATUSES, UploadStatus
+from apps.images.conversion import MIMETYPES
+from apps.images.events import notify_changed
 from apps.images.models import Image
-from apps.images.tasks import process_image_upload
+from apps.images.tasks import (
+    convert_image,
+    delete_image_objects,
+    mark_images_uploaded,
+    queue_uploaded_images,
+    resize_image,
+)
 from apps.images.serializers import (
+    ImageBulkDeleteSerializer,
+    ImageBulkUploadSerializer,
+    ImageMultipartPartSerializer,
+    ImageMultipartPartsInputSerializer,
+    ImageMultipartPartsSerializer,
+    ImageMultipartUploadSerializer,
     ImageSerializer,
     ImageUploadFinishedInputSerializer,
     ImageUploadSerializer,
     ImageRetrieveQuerySerializer,
+    ImageResizeQuerySerializer,
+    ImageListQuerySerializer,
 )
 
 logger = get_task_logger(__name__)
@@ -38,108 +70,349 @@ class ImageUploadViewSet(CreateModelMixin, GenericViewSet):
         This endpoint will help to create a s3 presigned post url.
         Using presigned post url, it's easy to upload image and will be synced with DB
         """
-        instance = super().create(request, *args, **kwargs)
+        return super().create(request, *args, **kwargs)
 
-        try:
-            # Update available extensions
-            image = Image.objects.get(id=instance.data.get("id"))
-            extension = image.name.split(".")[-1]
-            image.available_extensions.append(extension)
-            image.save()
-        except Exception as e:
-            logger.error("Image Conversion Error", e)
-            raise ValidationError(
-                {"error": "Something went wrong, while doing image conversion"}
-            )
+    @extend_schema(
+        request=ImageBulkUploadSerializer,
+        responses={201: ImageUploadSerializer(many=True)},
+    )
+    def bulk_create(self, request, *args, **kwargs):
+        """
+        This endpoint will create s3 presigned post urls for many images at once.
+        Images are created with a single insert
+        """
+        serializer = ImageBulkUploadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
 
-        # task will execute after 5 minutes to verify file uploaded
-        process_image_upload.s(image.id).apply_async(countdown=300)
+        images = Image.objects.bulk_create(
+            Image(**data) for data in serializer.validated_data["images"]
+        )
         return Response(
-            self.get_serializer(image, many=False).data, status=status.HTTP_201_CREATED
+            self.get_serializer(images, many=True).data, status=status.HTTP_201_CREATED
         )
 
 
+class ImageMultipartUploadViewSet(CreateModelMixin, GenericViewSet):
+    queryset = Image.objects.all()
+    serializer_class = ImageMultipartUploadSerializer
+    permission_classes = [AllowAny]
+    http_method_names = ["get", "post", "delete"]
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == "create":
+            return queryset
+        # Only images with a multipart upload in progress
+        return queryset.filter(status=UploadStatus.UPLOADING, upload_id__isnull=False)
+
+    def create(self, request, *args, **kwargs):
+        """
+        This endpoint will start a multipart upload, for large images.
+        Parts of part_size bytes are uploaded with pre-signed part urls, in parallel
+        """
+        return super().create(request, *args, **kwargs)
+
+    @extend_schema(responses={200: ImageMultipartPartSerializer(many=True)})
+    def retrieve(self, request, *args, **kwargs):
+        """
+        This endpoint will list parts uploaded so far.
+        After a failure, upload resumes with the missing parts only
+        """
+        instance = self.get_object()
+        try:
+            parts = list_uploaded_parts(instance.key, instance.upload_id)
+        except UploadError as e:
+            raise ValidationError({"error": str(e)})
+        return Response(ImageMultipartPartSerializer(parts, many=True).data)
+
+    @extend_schema(
+        request=ImageMultipartPartsInputSerializer,
+        responses={200: ImageMultipartPartsSerializer},
+    )
+    def parts(self, request, *args, **kwargs):
+        """
+        This endpoint will create pre-signed PUT urls of the given parts.
+        A failed part is uploaded again with a new url
+        """
+        serializer = ImageMultipartPartsInputSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        instance = self.get_object()
+
+        urls = generate_presigned_part_urls(
+            instance.key, instance.upload_id, serializer.validated_data["part_numbers"]
+        )
+        return Response(ImageMultipartPartsSerializer({"urls": urls}).data)
+
+    @extend_schema(request=None, responses={200: ImageSerializer})
+    def complete(self, request, *args, **kwargs):
+        """
+        This endpoint will combine uploaded parts into the image, and set image
+        upload status to uploaded
+        """
+        instance = self.get_object()
+        try:
+            complete_multipart_upload(
+                instance.key, instance.upload_id, instance.max_size
+            )
+        except UploadError as e:
+            raise ValidationError({"error": str(e)})
+
+        instance.status = UploadStatus.UPLOADED
+        instance.upload_id = None
+        instance.save(update_fields=["status", "upload_id", "updated_at"])
+        queue_uploaded_images([instance.id])
+        return Response(ImageSerializer(instance).data)
+
+    @extend_schema(responses={204: None})
+    def destroy(self, request, *args, **kwargs):
+        """
+        This endpoint will abort a multipart upload, uploaded parts are deleted
+        """
+        instance = self.get_object()
+        try:
+            abort_multipart_upload(instance.key, instance.upload_id)
+        except UploadError as e:
+            raise ValidationError({"error": str(e)})
+
+        instance.status = UploadStatus.ERROR
+        instance.message = "Upload aborted"
+        instance.upload_id = None
+        instance.save(update_fields=["status", "message", "upload_id", "updated_at"])
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class ImageUploadEventViewSet(GenericViewSet):
+    queryset = Image.objects.all()
+    serializer_class = S3EventSerializer
+    # Called by S3/MinIO with a shared token, not by users
+    authentication_classes = []
+    permission_classes = [AllowAny]
+    http_method_names = ["post"]
+
+    @extend_schema(responses={204: None})
+    def create(self, request, *args, **kwargs):
+        """
+        This endpoint receives bucket event notifications (S3/MinIO webhook).
+        Images are set to uploaded as soon as their ObjectCreated event arrives
+        """
+        token = settings.AWS_EVENTS_AUTH_TOKEN
+        authorization = request.headers.get("Authorization", "").split(" ")[-1]
+        if not token or not hmac.compare_digest(authorization, token):
+            raise PermissionDenied()
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        mark_images_uploaded(get_event_keys(serializer.validated_data["Records"]))
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+def build_image_response(instance, extension):
+    """
+    Status code, data and ETag of image details, for the API and async views.
+    If extension is not converted yet, conversion task is queued (202).
+    """
+    data = dict(ImageSerializer(instance).data)
+    status_code = status.HTTP_200_OK
+
+    # Only do image conversion, if image extension is not same
+    if extension and extension != instance.extension:
+        # Update data with new values
+        data["name"] = f"{''.join(instance.name.split('.')[:-1])}.{extension}"
+        data["mimetype"] = MIMETYPES.get(extension.lower())
+
+        if extension in instance.available_extensions:
+            data["presigned_url"] = generate_presigned_url(instance.get_key(extension))
+        elif instance.status not in CONVERTIBLE_STATUSES:
+            # Not uploaded yet, or failed (e.g. over decoding limits)
+            data["presigned_url"] = None
+        else:
+            # Conversion runs in celery, client can poll until converted file exists
+            convert_image.s(instance.id, extension).apply_async()
+            data["status"] = UploadStatus.PROCESSING.label
+            data["presigned_url"] = None
+            status_code = status.HTTP_202_ACCEPTED
+
+    etag = quote_etag(
+        hashlib.md5(
+            json.dumps(data, sort_keys=True, cls=DjangoJSONEncoder).encode()
+        ).hexdigest()
+    )
+    return status_code, data, etag
+
+
+def is_not_modified(request, etag):
+    """True if the client has this ETag already, from If-None-Match header"""
+    return etag in parse_etags(request.headers.get("If-None-Match", ""))
+
+
 class ImageViewSet(ModelViewSet):
     queryset = Image.objects.all()
     serializer_class = ImageSerializer
+    pagination_class = KeysetPagination
     permission_classes = [AllowAny]
-    http_method_names = ["get", "patch", "partial_update"]
+    http_method_names = ["get", "patch", "partial_update", "delete"]
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action != "list":
+            return queryset
+
+        query_serializer = ImageListQuerySerializer(data=self.request.query_params)
+        query_serializer.is_valid(raise_exception=True)
+        query_params = query_serializer.validated_data
+
+        if "status" in query_params:
+            queryset = queryset.filter(status=query_params["status"])
+        if "extension" in query_params:
+            queryset = queryset.filter(
+                available_extensions__contains=[query_params["extension"]]
+            )
+        if "created_after" in query_params:
+            queryset = queryset.filter(created_at__gte=query_params["created_after"])
+        if "created_before" in query_params:
+            queryset = queryset.filter(created_at__lt=query_params["created_before"])
+        return queryset
+
+    @extend_schema(parameters=[ImageListQuerySerializer])
+    def list(self, request, *args, **kwargs):
+        """
+        This endpoint will list images, newest first.
+        Images can be filtered by status, available extension and created time range.
+        """
+        return super().list(request, *args, **kwargs)
 
     @extend_schema(parameters=[ImageRetrieveQuerySerializer])
     def retrieve(self, request, *args, **kwargs):
         """
         This endpoint will give image details.
+        If requested extension is not converted yet, conversion task is queued and
+        responds with 202, call again later to get pre-signed url of converted image.
 
         :param extension: Different image formats can be returned by using a different image file type
         """
         query_serializer = ImageRetrieveQuerySerializer(data=self.request.query_params)
         query_serializer.is_valid(raise_exception=True)
-        query_params = query_serializer.data
+        extension = query_serializer.data.get("extension") or ""
 
+        try:
+            image_id = UUID(str(kwargs[self.lookup_field]))
+        except ValueError:
+            raise NotFound()
+
+        # Responses are cached until image changes, as clients poll for processing
+        version, responses = get_responses(image_id)
+        if extension not in responses:
+            responses[extension] = build_image_response(self.get_object(), extension)
+            set_responses(image_id, version, responses)
+
+        status_code, data, etag = responses[extension]
+        if is_not_modified(request, etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        return Response(data, status=status_code, headers={"ETag": etag})
+
+    @extend_schema(parameters=[ImageResizeQuerySerializer])
+    @action(methods=["get"], detail=True, url_path="resize")
+    def resize(self, request, *args, **kwargs):
+        """
+        This endpoint will give a resized image, of the given width, height and fit.
+        Resized image is generated once and stored, until then responds with 202,
+        call again later to get pre-signed url of resized image.
+
+        :param extension: Image format of resized image, original format by default
+        """
+        query_serializer = ImageResizeQuerySerializer(data=self.request.query_params)
+        query_serializer.is_valid(raise_exception=True)
+        params = query_serializer.validated_data
+
+        instance = self.get_object()
+        extension = params.get("extension") or instance.extension
+        options = {"quality": params["quality"]} if params.get("quality") else {}
+        key = instance.get_variant_key(
+            extension,
+            width=params["width"],
+            height=params["height"],
+            fit=params["fit"],
+            **options,
+        )
+
+        serializer = self.get_serializer(instance)
+        data = serializer.data
+        data["name"] = f"{''.join(instance.name.split('.')[:-1])}.{extension}"
+        data["mimetype"] = MIMETYPES.get(extension.lower())
+
+        if check_file_exists(key):
+            data["presigned_url"] = generate_presigned_url(key)
+            return Response(data)
+
+        if instance.status not in CONVERTIBLE_STATUSES:
+            # Not uploaded yet, or failed (e.g. over decoding limits)
+            data["presigned_url"] = None
+            return Response(data)
+
+        # Resize runs in celery, only one task encodes the same variant. Polls
+        # queue it once, again only if it could not have finished by then
+        queued = cache.add(f"resize-queued:{key}", True, settings.IMAGE_TASK_TIME_LIMIT)
+        if queued is not False:
+            resize_image.s(
+                instance.id,
+                params["width"],
+                params["height"],
+                params["fit"],
+                params.get("quality"),
+                extension,
+            ).apply_async()
+        data["status"] = UploadStatus.PROCESSING.label
+        data["presigned_url"] = None
+        return Response(data, status=status.HTTP_202_ACCEPTED)
+
+    def destroy(self, request, *args, **kwargs):
+        """
+        This endpoint will delete image.
+        Original and converted files are deleted from s3 in background
+        """
         instance = self.get_object()
-        extension = query_params.get("extension")
-
-        if extension:
-            serializer = self.get_serializer(instance)
-
-            key = instance.key
-            old_extension = key.split(".")[-1]
-
-            # Extensions dict for easy mimtype mapping
-            extensions = {
-                "jpg": "image/jpg",
-                "jpeg": "image/jpeg",
-                "png": "image/png",
-            }
-
-            try:
-                # Only do image conversion, if image extension is not same
-                if old_extension != extension:
-                    new_key = f"images/{instance.id}/image-{instance.id}.{extension}"
-
-                    # If converted file not exits, download image to memory and upload with converted file back to s3
-                    if not check_file_exists(new_key):
-                        fileobj = download_fileobj(key)
-                        upload_fileobj(
-                            new_key, fileobj
-                        )  # Todo: Need to convert with actual encoding
-
-                        # Update available extensions
-                        instance.available_extensions.append(extension)
-                        instance.save()
-
-                    # Update data with new values
-                    data = serializer.data
-                    data[
-                        "name"
-                    ] = f"{''.join(instance.name.split('.')[:-1])}.{extension}"
-                    data["mimetype"] = extensions.get(extension.lower())
-                    data["presigned_url"] = generate_presigned_url(new_key)
-                    return Response(data)
-            except Exception as e:
-                logger.error("Image Conversion Error", e)
-                raise ValidationError(
-                    {"error": "Something went wrong, while doing image conversion"}
-                )
-
-        return super().retrieve(request, *args, **kwargs)
+        storage_id = instance.storage_id
+        uploads = [(instance.key, instance.upload_id)] if instance.upload_id else []
+        instance.delete()
+        delete_image_objects.s([storage_id], uploads).apply_async()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @extend_schema(request=ImageBulkDeleteSerializer, responses={204: None})
+    @action(methods=["delete"], detail=False, url_path="bulk")
+    def bulk_destroy(self, request, *args, **kwargs):
+        """
+        This endpoint will delete many images at once, with a single delete query.
+        Original and converted files are deleted from s3 in background
+        """
+        serializer = ImageBulkDeleteSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        queryset = Image.objects.filter(id__in=serializer.validated_data["ids"])
+        images = list(queryset.only("id", "name", "canonical_id", "upload_id"))
+        if images:
+            storage_ids = {image.storage_id for image in images}
+            uploads = [
+                (image.key, image.upload_id) for image in images if image.upload_id
+            ]
+            queryset.delete()
+            notify_changed(serializer.validated_data["ids"])
+            delete_image_objects.s(list(storage_ids), uploads).apply_async()
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
     @extend_schema(request=ImageUploadFinishedInputSerializer)
     @action(methods=["patch"], detail=True, url_path="upload-finished")
     def upload_finished(self, request, *args, **kwargs):
         """
         This endpoint will set image upload status to uploaded.
-        If image not uploaded to s3, it will create a celery task to check after 5 minutes
+        If image not uploaded to s3, periodic upload sweep will check it later
         """
         instance = self.get_object()
 
         # Update status if file exists
         if check_file_exists(instance.key):
             instance.status = UploadStatus.UPLOADED
-            instance.save()
-        else:
-            # task will execute after 5 minutes to verify file uploaded
-            process_image_upload.s(instance.id).apply_async(countdown=300)
+            instance.save(update_fields=["status", "updated_at"])
+            queue_uploaded_images([instance.id])
 
         serializer = self.get_serializer(instance, many=False)
         return Response(serializer.data)
@@ -1,8 +1,20 @@
 import os
+import resource
 
 from celery import Celery
+from celery.signals import worker_process_init
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "image_jinn.settings")
 app = Celery("core")
 app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()
+
+
+@worker_process_init.connect
+def limit_worker_memory(**kwargs):
+    """Cap address space of pool processes, a runaway decode fails only its task"""
+    from django.conf import settings
+
+    if settings.IMAGE_WORKER_MEMORY_LIMIT:
+        limit = settings.IMAGE_WORKER_MEMORY_LIMIT
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
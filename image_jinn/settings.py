@@ -101,6 +101,20 @@ DATABASES = {
 }
 
 
+# Cache
+CACHES = {
+    "default": {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": env("CACHE_URL", "redis://127.0.0.1:6379/1"),
+        "OPTIONS": {
+            "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            # Cache is only an optimization, fallback to the source if redis is down
+            "IGNORE_EXCEPTIONS": True,
+        },
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -169,14 +183,44 @@ SPECTACULAR_SETTINGS = {
     },
 }
 
+# Storage backend, S3 or local file system (apps.contrib.backends.FileSystemBackend)
+STORAGE_BACKEND = env("STORAGE_BACKEND", "apps.contrib.storage.S3Backend")
+# File system storage, files root and url prefix of pre-signed urls
+STORAGE_ROOT = env("STORAGE_ROOT", str(BASE_DIR / "storage"))
+STORAGE_URL = env("STORAGE_URL", "/storage/")
+
 # AWS
 AWS_ACCESS_KEY_ID = env("AWS_ACCESS_KEY_ID", "minioadmin")
 AWS_SECRET_ACCESS_KEY = env("AWS_SECRET_ACCESS_KEY", "minioadmin")
 AWS_BUCKET_NAME = env("AWS_BUCKET_NAME", "bucket")
 AWS_BUCKET_REGION = env("AWS_BUCKET_REGION", "ap-south-1")
 AWS_EXPIRY = 604700
+# Fraction of AWS_EXPIRY a pre-signed url is reused for, 0 signs on every request
+AWS_PRESIGNED_URL_REUSE = float(env("AWS_PRESIGNED_URL_REUSE", 0.5))
 AWS_S3_ENDPOINT_URL = env("AWS_S3_ENDPOINT_URL", "http://127.0.0.1:9000")
 AWS_S3_ADDRESSING_STYLE = env("AWS_S3_ADDRESSING_STYLE")
+# S3 client, connections shared by threads of a process, retries and timeouts (seconds)
+AWS_MAX_POOL_CONNECTIONS = int(env("AWS_MAX_POOL_CONNECTIONS", 100))
+AWS_RETRY_MODE = env("AWS_RETRY_MODE", "adaptive")
+AWS_MAX_ATTEMPTS = int(env("AWS_MAX_ATTEMPTS", 5))
+AWS_CONNECT_TIMEOUT = float(env("AWS_CONNECT_TIMEOUT", 5))
+AWS_READ_TIMEOUT = float(env("AWS_READ_TIMEOUT", 30))
+# Managed uploads, multipart over the threshold with concurrent part uploads
+AWS_MULTIPART_THRESHOLD = int(env("AWS_MULTIPART_THRESHOLD", 16 * 1024 * 1024))
+AWS_MULTIPART_CHUNK_SIZE = int(env("AWS_MULTIPART_CHUNK_SIZE", 8 * 1024 * 1024))
+AWS_MULTIPART_CONCURRENCY = int(env("AWS_MULTIPART_CONCURRENCY", 10))
+# Expiry (seconds) of pre-signed part urls of client multipart uploads
+AWS_MULTIPART_UPLOAD_EXPIRY = int(env("AWS_MULTIPART_UPLOAD_EXPIRY", 60 * 60))
+# Shared secret of bucket event notifications webhook, disabled if not set
+AWS_EVENTS_AUTH_TOKEN = env("AWS_EVENTS_AUTH_TOKEN")
+# Transfers are buffered in memory up to this size, bigger files spill to a temp file
+AWS_SPOOL_MAX_SIZE = int(env("AWS_SPOOL_MAX_SIZE", 16 * 1024 * 1024))
+AWS_TRANSFER_CHUNK_SIZE = int(env("AWS_TRANSFER_CHUNK_SIZE", 1024 * 1024))
+# Threads running S3 requests of async views, i.e. S3 round-trips in flight per worker
+AWS_ASYNC_MAX_WORKERS = int(env("AWS_ASYNC_MAX_WORKERS", 100))
+# Object existence cache timeouts (seconds), for found and missing keys
+AWS_EXISTS_CACHE_TIMEOUT = int(env("AWS_EXISTS_CACHE_TIMEOUT", 24 * 60 * 60))
+AWS_EXISTS_NEGATIVE_CACHE_TIMEOUT = int(env("AWS_EXISTS_NEGATIVE_CACHE_TIMEOUT", 5))
 
 # Celery
 CELERY_BROKER_URL = env("CELERY_BROKER_URL", "redis://127.0.0.1:6379")
@@ -185,3 +229,84 @@ CELERY_ACCEPT_CONTENT = ["application/json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = "UTC"
+# Pool processes are replaced after a task leaves them over this resident memory (KiB)
+CELERY_WORKER_MAX_MEMORY_PER_CHILD = int(
+    env("CELERY_WORKER_MAX_MEMORY_PER_CHILD", 1024 * 1024)
+)
+CELERY_BEAT_SCHEDULE = {
+    "sweep-image-uploads": {
+        "task": "apps.images.sweep_image_uploads",
+        "schedule": 60.0,
+    },
+}
+
+# Upload sweep verifies images still uploading after this many seconds,
+# if upload event or upload finished call is missed
+IMAGE_UPLOAD_SWEEP_AGE = int(env("IMAGE_UPLOAD_SWEEP_AGE", 300))
+IMAGE_UPLOAD_SWEEP_BATCH_SIZE = int(env("IMAGE_UPLOAD_SWEEP_BATCH_SIZE", 1000))
+# Bucket listing pages (1000 keys each) read per sweep, the rest is checked per key
+IMAGE_UPLOAD_SWEEP_MAX_PAGES = int(env("IMAGE_UPLOAD_SWEEP_MAX_PAGES", 100))
+
+# Multipart uploads, part size (at least 5MB, S3 minimum) and parts signed per request.
+# Unfinished multipart uploads are aborted by the upload sweep after
+# IMAGE_MULTIPART_SWEEP_AGE
+IMAGE_MULTIPART_PART_SIZE = int(env("IMAGE_MULTIPART_PART_SIZE", 8 * 1024 * 1024))
+IMAGE_MULTIPART_MAX_PARTS_PER_REQUEST = int(
+    env("IMAGE_MULTIPART_MAX_PARTS_PER_REQUEST", 1000)
+)
+IMAGE_MULTIPART_SWEEP_AGE = int(env("IMAGE_MULTIPART_SWEEP_AGE", 24 * 60 * 60))
+
+# Maximum images in one bulk upload request
+IMAGE_BULK_UPLOAD_MAX_SIZE = int(env("IMAGE_BULK_UPLOAD_MAX_SIZE", 500))
+
+# Maximum images in one bulk delete request
+IMAGE_BULK_DELETE_MAX_SIZE = int(env("IMAGE_BULK_DELETE_MAX_SIZE", 1000))
+
+# Image detail responses are cached until image changes, for at most this many seconds
+IMAGE_RESPONSE_CACHE_TIMEOUT = int(env("IMAGE_RESPONSE_CACHE_TIMEOUT", 300))
+
+# Redis pub/sub of image changes, wakes clients waiting for upload status changes
+IMAGE_EVENTS_URL = env("IMAGE_EVENTS_URL", "redis://127.0.0.1:6379/2")
+# Longest wait (seconds) of the wait endpoint, keep below proxy read timeouts
+IMAGE_WAIT_MAX_TIMEOUT = int(env("IMAGE_WAIT_MAX_TIMEOUT", 55))
+
+# Maximum upload size (bytes) by mimetype, enforced by pre-signed post policies and
+# upload verification, larger files are rejected before any decoding
+IMAGE_UPLOAD_MAX_SIZES = {
+    "image/jpg": int(env("IMAGE_JPEG_MAX_SIZE", 25 * 1024 * 1024)),
+    "image/jpeg": int(env("IMAGE_JPEG_MAX_SIZE", 25 * 1024 * 1024)),
+    "image/png": int(env("IMAGE_PNG_MAX_SIZE", 50 * 1024 * 1024)),
+}
+
+# Bytes read from the start of uploads to detect format, dimensions and orientation
+IMAGE_HEADER_SIZE = int(env("IMAGE_HEADER_SIZE", 64 * 1024))
+
+# Uploads with the same content as an earlier image share its files and derivatives
+IMAGE_DEDUPLICATION = env("IMAGE_DEDUPLICATION", "1") == "1"
+
+# Renditions generated after upload, resized into width x height box,
+# fit: contain (whole image inside the box) or cover (fill the box, cropped at center)
+IMAGE_RENDITIONS = {
+    "thumb": {"width": 200, "height": 200, "fit": "cover", "extension": "jpg"},
+    "medium": {"width": 800, "height": 800, "fit": "contain", "extension": "jpg"},
+    "large": {"width": 1600, "height": 1600, "fit": "contain", "extension": "jpg"},
+}
+
+# Maximum width and height of on the fly resized images
+IMAGE_RESIZE_MAX_SIZE = int(env("IMAGE_RESIZE_MAX_SIZE", 4096))
+
+# Decoding limits, images over IMAGE_MAX_PIXELS (checked from the header) are set to
+# error without decoding, decoded RGBA pixels take 4 bytes each
+IMAGE_MAX_PIXELS = int(env("IMAGE_MAX_PIXELS", 50_000_000))
+# Time limits (seconds) of decoding tasks, soft limit sets the image to error
+IMAGE_TASK_SOFT_TIME_LIMIT = int(env("IMAGE_TASK_SOFT_TIME_LIMIT", 120))
+IMAGE_TASK_TIME_LIMIT = int(env("IMAGE_TASK_TIME_LIMIT", 150))
+# Address space limit (bytes) of each celery pool process, allocations over it fail
+# with MemoryError instead of the OOM killer taking the pool down. 0 disables it
+IMAGE_WORKER_MEMORY_LIMIT = int(env("IMAGE_WORKER_MEMORY_LIMIT", 0))
+
+# Image conversion, Pillow encoder options by format
+IMAGE_ENCODER_OPTIONS = {
+    "JPEG": {"quality": 85, "optimize": True, "progressive": True},
+    "PNG": {"optimize": True},
+}
@@ -13,6 +13,9 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from urllib.parse import urlsplit
+
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
 
@@ -25,6 +28,10 @@ from drf_spectacular.views import (
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/images/", include("apps.images.urls")),
+    # Async endpoints, for ASGI deployments
+    path("api/async/images/", include("apps.images.async_urls")),
+    # Pre-signed urls of file system storage
+    path(urlsplit(settings.STORAGE_URL).path.lstrip("/"), include("apps.contrib.urls")),
     # Swagger
     path("schema/", SpectacularAPIView.as_view(), name="schema"),
     path("api/", SpectacularSwaggerView.as_view(url_name="schema"), name="swagger-ui"),